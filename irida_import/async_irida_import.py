@@ -0,0 +1,182 @@
+"""
+Copyright Government of Canada 2015-2020
+
+Written by: National Microbiology Laboratory, Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import asyncio
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from irida_import.irida_import import IridaImport
+
+
+class AsyncIridaImport(IridaImport):
+
+    """
+    Imports sample's sample files from IRIDA, driving the work with asyncio.
+
+    Every IRIDA metadata request, file transfer, Galaxy request and dataset
+    state poll is a coroutine on a single event loop. Concurrency is
+    limited per server: at most max_irida_workers operations run against
+    IRIDA and max_transfer_workers against Galaxy. Blocking HTTP calls run
+    on one small thread pool sized to those limits, so operations waiting
+    for a free slot, or waiting between polls, do not hold a thread. Work
+    that already holds a slot runs the calls it makes inline, instead of
+    waiting for a second slot that may never come free.
+
+    The library layout and summary are the same as those of IridaImport.
+    """
+
+    def import_to_galaxy(self, *args, **kwargs):
+        """
+        Import samples and their sample files into Galaxy from IRIDA
+
+        Takes the same arguments as IridaImport.import_to_galaxy, which runs
+        on the calling thread while the event loop runs on its own thread.
+        """
+        self._start_loop()
+        try:
+            return super().import_to_galaxy(*args, **kwargs)
+        finally:
+            self._stop_loop()
+
+    def _start_loop(self):
+        """Start the event loop, on its own thread, and the thread pool"""
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(
+            max_workers=(self.config.MAX_IRIDA_WORKERS +
+                         self.config.MAX_TRANSFER_WORKERS))
+        self._loop_thread = threading.Thread(target=self._loop.run_forever)
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+        # Whether the current thread is running a call that holds a slot
+        self._slot = threading.local()
+        self._limits = self._run(self._make_limits())
+
+    def _stop_loop(self):
+        """Stop the event loop and the thread pool"""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._executor.shutdown()
+
+    async def _make_limits(self):
+        """Create the per-server limits, on the event loop they are used on"""
+        return {
+            'irida': asyncio.Semaphore(max(1, self.config.MAX_IRIDA_WORKERS)),
+            'galaxy': asyncio.Semaphore(max(1, self.config.MAX_TRANSFER_WORKERS)),
+        }
+
+    def _run(self, coroutine):
+        """Run a coroutine on the event loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _call(self, host, func, *args):
+        """
+        Call a blocking function on the thread pool, once the server it
+        talks to has a free slot
+        """
+        async with self._limits[host]:
+            return await self._loop.run_in_executor(
+                self._executor, self._call_in_slot, func, *args)
+
+    def _call_in_slot(self, func, *args):
+        """Call a function, marking the thread as holding a slot"""
+        self._slot.held = True
+        try:
+            return func(*args)
+        finally:
+            self._slot.held = False
+
+    def _holds_slot(self):
+        return getattr(self._slot, 'held', False)
+
+    async def _gather(self, coroutines):
+        return await asyncio.gather(*coroutines, return_exceptions=True)
+
+    def _map_in_pool(self, func, items, max_workers, describe, host='galaxy'):
+        """
+        Call a function on every item, as one coroutine per item limited by
+        the concurrency limit of host. See IridaImport._map_in_pool.
+        """
+        items = list(items)
+        if self._holds_slot():
+            # The slot held already limits this work, and the executor's
+            # threads may all be busy waiting on calls like this one
+            results = []
+            for item in items:
+                try:
+                    results.append(func(item))
+                except Exception as error:
+                    results.append(error)
+        else:
+            results = self._run(self._gather(
+                [self._call(host, func, item) for item in items]))
+
+        errors = [(item, result) for item, result in zip(items, results)
+                  if isinstance(result, Exception)]
+        self._raise_item_errors(errors, describe)
+
+        return results
+
+    def verify_samples_integrity(self, sample_files):
+        """
+        Checks to see if a group of sample files were uploaded successfully
+
+        Each pending dataset is polled by its own coroutine, backing off
+        exponentially between polls without holding a thread.
+        See IridaImport.verify_samples_integrity.
+
+        :type sample_files: list
+        :param sample_files: the SampleFiles to verify upload
+        :return: a list of booleans indicating whether each sample file was
+        uploaded successfully
+        """
+        if self._holds_slot():
+            # Polled inline, see _map_in_pool
+            return super().verify_samples_integrity(sample_files)
+
+        pending = self._unverified(sample_files)
+        for sample_file in pending:
+            self.logger.debug(time.strftime("[%D %H:%M:%S]:") +
+                              ' Verifying integrity of: ' +
+                              sample_file.name)
+
+        start = time.time()
+        results = self._run(self._gather(
+            [self._verify(sample_file, start) for sample_file in pending]))
+
+        errors = [(sample_file, result)
+                  for sample_file, result in zip(pending, results)
+                  if isinstance(result, Exception)]
+        self._raise_item_errors(
+            errors, lambda sample_file: "state of '{0}'".format(sample_file.name))
+
+        return [sample_file.verified for sample_file in sample_files]
+
+    async def _verify(self, sample_file, start):
+        """Poll the state of a sample file's dataset until it is final"""
+        delay = self.POLL_INITIAL_DELAY
+        while True:
+            state = await self._call(
+                'galaxy', sample_file.state, self.reg_gi, self.library.id)
+            pending = await self._call(
+                'galaxy', self._check_state, sample_file, state, start)
+            if not pending:
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.POLL_MAX_DELAY)
@@ -94,12 +94,68 @@ class Config:
             self.REFERENCE_PATH = config.get('Galaxy', 'reference_path')
             self.XML_FILE = config.get('Galaxy', 'xml_file')
             self.MAX_WAITS = int(config.get('Galaxy', 'max_waits'))
-            self.MAX_RETRIES = 3
+
+            # Extra time allowed for large files to finish uploading
+            try:
+                self.WAIT_SECONDS_PER_GB = int(config.get('Galaxy', 'wait_seconds_per_gb'))
+            except:
+                self.WAIT_SECONDS_PER_GB = 60
+
+            # Number of times, and seconds before the first time, failed
+            # files are retried. The delay doubles with every retry.
+            try:
+                self.MAX_RETRIES = int(config.get('Galaxy', 'max_retries'))
+            except:
+                self.MAX_RETRIES = 3
+
+            try:
+                self.RETRY_DELAY = int(config.get('Galaxy', 'retry_delay'))
+            except:
+                self.RETRY_DELAY = 5
 
             # Used to reconnect to Galaxy instance when connection is lost
             self.MAX_CLIENT_ATTEMPTS = int(config.get('Galaxy', 'max_client_http_attempts'))
             self.CLIENT_RETRY_DELAY = int(config.get('Galaxy', 'client_http_retry_delay'))
 
+            # Number of files downloaded and uploaded to Galaxy at once
+            try:
+                self.MAX_TRANSFER_WORKERS = int(config.get('Galaxy', 'max_transfer_workers'))
+            except:
+                self.MAX_TRANSFER_WORKERS = 4
+
+            # Number of local files linked into a library folder per request
+            try:
+                self.LINK_BATCH_SIZE = int(config.get('Galaxy', 'link_batch_size'))
+            except:
+                self.LINK_BATCH_SIZE = 100
+
+            # Build paired collections straight from the library datasets,
+            # instead of from copies of them in the history
+            try:
+                self.COLLECTIONS_FROM_LIBRARY = config.getboolean('Galaxy', 'collections_from_library')
+            except:
+                self.COLLECTIONS_FROM_LIBRARY = False
+
+            # Directory files downloaded from IRIDA are kept in, and the
+            # most space they may take up. No directory turns the cache off.
+            try:
+                self.DOWNLOAD_CACHE_DIR = config.get('Galaxy', 'download_cache_dir')
+            except:
+                self.DOWNLOAD_CACHE_DIR = ''
+
+            try:
+                self.DOWNLOAD_CACHE_MAX_GB = int(config.get('Galaxy', 'download_cache_max_gb'))
+            except:
+                self.DOWNLOAD_CACHE_MAX_GB = 50
+
+            # How files that are not local to Galaxy get there: 'upload'
+            # downloads them and uploads them to Galaxy, 'fetch' has Galaxy
+            # fetch them from IRIDA itself
+            try:
+                self.TRANSFER_MODE = config.get('Galaxy', 'transfer_mode')
+            except:
+                self.TRANSFER_MODE = 'upload'
+
             try:
                 self.TOOL_ID = config.get('Galaxy', 'tool_id')
             except:
@@ -115,6 +171,8 @@ class Config:
             except:
                 self.TOOL_FILE = 'irida_import.xml'
 
+            self.PATH_MAPPINGS = self._load_path_mappings()
+
             self.TOKEN_ENDPOINT_SUFFIX = config.get('IRIDA',
                                                     'token_endpoint_suffix')
             self.INITIAL_ENDPOINT_SUFFIX = config.get('IRIDA',
@@ -127,6 +185,68 @@ class Config:
             self.CLIENT_ID = config.get('IRIDA', 'client_id')
             self.CLIENT_SECRET = config.get('IRIDA', 'client_secret')
 
+            # Number of samples resolved against the IRIDA API at once
+            try:
+                self.MAX_IRIDA_WORKERS = int(config.get('IRIDA', 'max_irida_workers'))
+            except:
+                self.MAX_IRIDA_WORKERS = 8
+
+            # Number of times a download is resumed after the connection to
+            # IRIDA drops
+            try:
+                self.MAX_DOWNLOAD_RESUMES = int(config.get('IRIDA', 'max_download_resumes'))
+            except:
+                self.MAX_DOWNLOAD_RESUMES = 10
+
+            # Files of at least segmented_download_min_mb MB are downloaded
+            # as download_segments byte ranges at once
+            try:
+                self.DOWNLOAD_SEGMENTS = int(config.get('IRIDA', 'download_segments'))
+            except:
+                self.DOWNLOAD_SEGMENTS = 4
+
+            try:
+                self.SEGMENTED_DOWNLOAD_MIN_BYTES = int(
+                    config.get('IRIDA', 'segmented_download_min_mb')) * 1024 * 1024
+            except:
+                self.SEGMENTED_DOWNLOAD_MIN_BYTES = 1024 * 1024 * 1024
+
+            # Directory IRIDA responses are cached in, and the most space
+            # they may take up. No directory turns the cache off.
+            try:
+                self.RESPONSE_CACHE_DIR = config.get('IRIDA', 'response_cache_dir')
+            except:
+                self.RESPONSE_CACHE_DIR = ''
+
+            try:
+                self.RESPONSE_CACHE_MAX_MB = int(config.get('IRIDA', 'response_cache_max_mb'))
+            except:
+                self.RESPONSE_CACHE_MAX_MB = 256
+
+
+    def _load_path_mappings(self):
+        """
+        Load the [Path Mappings] section, which rewrites the prefixes of
+        IRIDA file paths into the paths the same files have on the Galaxy
+        server, such as a shared file system mounted somewhere else
+
+        :return: a list of (IRIDA prefix, Galaxy prefix) tuples, longest
+        IRIDA prefix first
+        """
+        # A parser of its own, since paths are case sensitive and may
+        # contain '%'
+        config = configparser.RawConfigParser()
+        config.optionxform = str
+        config.read(self.CONFIG_FILE)
+        if not config.has_section('Path Mappings'):
+            return []
+
+        mappings = [(irida_prefix.rstrip('/'), galaxy_prefix.rstrip('/'))
+                    for irida_prefix, galaxy_prefix
+                    in config.items('Path Mappings')]
+        return sorted(mappings, key=lambda mapping: len(mapping[0]),
+                      reverse=True)
+
     def generate_xml(self):
         """
         Generate the tools xml file
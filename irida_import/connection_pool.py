@@ -0,0 +1,90 @@
+"""
+Copyright Government of Canada 2015-2020
+
+Written by: National Microbiology Laboratory, Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+def mount_pool(session, pool_size):
+    """
+    Give a session a connection pool that keeps pool_size connections alive
+    per host
+
+    :type session: requests.Session
+    :param session: the session to size the connection pool of
+    :type pool_size: int
+    :param pool_size: the number of connections kept alive per host, which
+    should be the number of threads using the session at once
+    :return: the session
+    """
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def pool_stats(session):
+    """
+    Get the connection reuse statistics of a session
+
+    :type session: requests.Session
+    :param session: the session to get the statistics of
+    :return: a list of (host, connections opened, requests sent) tuples
+    """
+    stats = []
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen or not hasattr(adapter, 'poolmanager'):
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats.append((pool.host, pool.num_connections, pool.num_requests))
+    return stats
+
+
+class SessionRequests:
+
+    """
+    Stands in for the requests module in bioblend, which sends each request
+    on a new connection, so that bioblend's requests are sent over a single
+    pooled session instead.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.session.put(url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.session.patch(url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.session.delete(url, **kwargs)
+
+    def __getattr__(self, name):
+        # Everything else, like the exceptions, comes from requests itself
+        return getattr(requests, name)
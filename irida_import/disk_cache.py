@@ -0,0 +1,392 @@
+"""
+Copyright Government of Canada 2015-2020
+
+Written by: National Microbiology Laboratory, Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def _disk_size(path):
+    """Get the bytes held by a file, or by all the files under a directory"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def _remove(path):
+    """Remove a file or a directory, if it is still there"""
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class DiskLRU:
+
+    """
+    A directory of files holding at most max_bytes, evicting the least
+    recently used files first.
+
+    Recency is kept in the files' modification times, so it carries over
+    from one run to the next. Temporary files and directories, whose names
+    start with a '.', count toward max_bytes too, so those left behind by an
+    interrupted run are evicted in turn.
+
+    Several processes may share the directory. A temporary entry is only
+    evicted once it has not been modified for TEMP_GRACE_SECONDS, and never
+    while it is locked by one of them.
+    """
+
+    TEMP_GRACE_SECONDS = 60 * 60
+    # Holds the lock files of keys, see locked
+    LOCK_DIR = '.locks'
+    # Keys share one of this many lock files, so that they do not pile up
+    LOCK_STRIPES = 4096
+
+    def __init__(self, directory, max_bytes):
+        """
+        :type directory: str
+        :param directory: the directory to keep the files in, created if
+        necessary
+        :type max_bytes: int
+        :param max_bytes: the most bytes the files may hold altogether
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(self.path(self.LOCK_DIR)):
+            os.makedirs(self.path(self.LOCK_DIR), exist_ok=True)
+
+        # File sizes by key, least recently used first
+        self._sizes = OrderedDict()
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name == self.LOCK_DIR:
+                continue
+            if entry.is_file() or entry.name.startswith('.'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.name,
+                                    _disk_size(entry.path)))
+                except OSError:
+                    pass
+        for _, key, size in sorted(entries):
+            self._sizes[key] = size
+        self.size = sum(self._sizes.values())
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Get the path of a file, marking it as the most recently used
+
+        :return: the path of the file, or None if it is not in the cache
+        """
+        with self._lock:
+            if key not in self._sizes:
+                return None
+            self._sizes.move_to_end(key)
+            path = self.path(key)
+            try:
+                os.utime(path, None)
+            except OSError:
+                # Removed by another process sharing the directory
+                self.size -= self._sizes.pop(key)
+                return None
+            return path
+
+    def put(self, key, file_path):
+        """
+        Move a file into the cache, evicting files if it is over capacity
+
+        :type file_path: str
+        :param file_path: the file to move, which should be on the same file
+        system as the cache directory
+        :return: whether the file was kept in the cache
+        """
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            os.remove(file_path)
+            return False
+
+        with self._lock:
+            os.replace(file_path, self.path(key))
+            self._add(key, size)
+        return True
+
+    def track(self, key):
+        """
+        Count a file that was written to the cache directory without put,
+        like an interrupted download, evicting files if it is over capacity
+        """
+        try:
+            size = _disk_size(self.path(key))
+        except OSError:
+            return
+        with self._lock:
+            self._add(key, size)
+
+    def untrack(self, key):
+        """Stop counting a file, so that it is not evicted while in use"""
+        with self._lock:
+            self.size -= self._sizes.pop(key, 0)
+
+    def _add(self, key, size):
+        """Count a file as the most recently used, with the lock held"""
+        self.size += size - self._sizes.pop(key, 0)
+        self._sizes[key] = size
+        while self.size > self.max_bytes and self._evict_one(key):
+            pass
+
+    def _evict_one(self, keep):
+        """
+        Remove the least recently used file that is not in use, other than
+        keep, with the lock held
+
+        :return: whether a file was removed
+        """
+        for key in self._sizes:
+            if key != keep and self._remove_unused(key):
+                self.size -= self._sizes.pop(key)
+                return True
+        return False
+
+    def _remove_unused(self, key):
+        """
+        Remove a file, unless it is a temporary entry that another thread
+        or process may be using
+
+        :return: whether the file is gone
+        """
+        path = self.path(key)
+        if not key.startswith('.'):
+            _remove(path)
+            return True
+
+        try:
+            if time.time() - os.stat(path).st_mtime < self.TEMP_GRACE_SECONDS:
+                return False
+        except OSError:
+            # Already removed
+            return True
+        try:
+            # Temporary directories are locked themselves, files by key
+            if os.path.isdir(path):
+                lock_fd = os.open(path, os.O_RDONLY)
+            else:
+                lock_fd = os.open(self._lock_path(key),
+                                  os.O_RDONLY | os.O_CREAT)
+        except OSError:
+            return False
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            _remove(path)
+            return True
+        finally:
+            os.close(lock_fd)
+
+    def _lock_path(self, key):
+        stripe = int(hashlib.sha256(key.encode('utf-8')).hexdigest(), 16)
+        return os.path.join(self.directory, self.LOCK_DIR,
+                            str(stripe % self.LOCK_STRIPES))
+
+    @contextmanager
+    def locked(self, key):
+        """
+        Hold the lock of a key, across threads and processes, so that its
+        temporary file is not written or evicted by anyone else meanwhile
+        """
+        lock_fd = os.open(self._lock_path(key), os.O_RDONLY | os.O_CREAT)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(lock_fd)
+
+    def temp_file(self, mode='w'):
+        """Open a temporary file in the cache directory, to put in later"""
+        return tempfile.NamedTemporaryFile(
+            mode=mode, dir=self.directory, prefix='.', delete=False)
+
+    @contextmanager
+    def temp_dir(self):
+        """
+        Make a temporary directory in the cache directory, locked so that it
+        is not evicted while in use, and removed afterwards
+        """
+        path = tempfile.mkdtemp(dir=self.directory, prefix='.')
+        try:
+            lock_fd = os.open(path, os.O_RDONLY)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                yield path
+            finally:
+                os.close(lock_fd)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class ResponseCache:
+
+    """
+    Caches IRIDA API responses on disk, so that unchanged resources can be
+    revalidated with a conditional GET instead of being fetched again.
+
+    Responses are keyed by user and URL, so users never see responses made
+    for another user.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.lru = DiskLRU(directory, max_bytes)
+
+    def _key(self, user, url):
+        return hashlib.sha256(
+            '{0}\n{1}'.format(user, url).encode('utf-8')).hexdigest()
+
+    def get(self, user, url):
+        """
+        Get a cached response
+
+        :return: a dict of the 'etag', 'last_modified' and 'body' of the
+        response, or None if it is not cached
+        """
+        path = self.lru.get(self._key(user, url))
+        if path is None:
+            return None
+        try:
+            with open(path, 'r') as entry_fh:
+                return json.load(entry_fh)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, user, url, etag, last_modified, body):
+        """Cache a response along with its validators"""
+        with self.lru.temp_file() as entry_fh:
+            json.dump({'etag': etag, 'last_modified': last_modified,
+                       'body': body}, entry_fh)
+        self.lru.put(self._key(user, url), entry_fh.name)
+
+
+class DownloadCache:
+
+    """
+    Keeps files downloaded from IRIDA on disk, addressed by their content,
+    so that a file imported more than once is only downloaded once.
+
+    Files are keyed by their uploadSha256, or by their URL and size when
+    IRIDA did not provide one.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.lru = DiskLRU(directory, max_bytes)
+
+    def _key(self, sample_file):
+        if sample_file.upload_sha_256:
+            return 'sha256-' + sample_file.upload_sha_256.lower()
+        if sample_file.file_size is not None:
+            return 'href-' + hashlib.sha256('{0}\n{1}'.format(
+                sample_file.href, sample_file.file_size).encode('utf-8')).hexdigest()
+        return None
+
+    def get(self, sample_file, file_path):
+        """
+        Put the cached copy of a sample file at file_path
+
+        :type sample_file: SampleFile
+        :param sample_file: the sample file to look for
+        :type file_path: str
+        :param file_path: where to put the file, preferably on the same file
+        system as the cache so that it can be hard linked
+        :return: whether the sample file was in the cache
+        """
+        key = self._key(sample_file)
+        cached_path = self.lru.get(key) if key is not None else None
+        if cached_path is None:
+            return False
+
+        try:
+            try:
+                os.link(cached_path, file_path)
+            except OSError:
+                shutil.copyfile(cached_path, file_path)
+        except (IOError, OSError):
+            # Evicted since it was looked up
+            return False
+        return True
+
+    def put(self, sample_file, file_path):
+        """
+        Move a downloaded sample file into the cache
+
+        :return: whether the file was kept in the cache
+        """
+        key = self._key(sample_file)
+        if key is None:
+            return False
+        return self.lru.put(key, file_path)
+
+    @contextmanager
+    def partial(self, sample_file):
+        """
+        Hold the path an interrupted download of a sample file is kept at
+
+        Only one download of a URL holds its path at a time, in any of the
+        processes sharing the cache, so sample files sharing a URL wait for
+        each other. An interrupted download is counted as part of the cache
+        once it is let go of.
+
+        :return: a context manager giving the path
+        """
+        key = '.partial-' + hashlib.sha256(
+            sample_file.href.encode('utf-8')).hexdigest()
+        with self.lru.locked(key):
+            self.lru.untrack(key)
+            try:
+                yield self.lru.path(key)
+            finally:
+                self.lru.track(key)
+
+    def temp_dir(self):
+        """
+        Make a temporary directory on the same file system as the cache
+
+        :return: a context manager giving the path of the directory, which
+        is removed on exit
+        """
+        return self.lru.temp_dir()
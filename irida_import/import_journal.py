@@ -0,0 +1,296 @@
+"""
+Copyright Government of Canada 2015-2020
+
+Written by: National Microbiology Laboratory, Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import json
+import os
+import threading
+
+from irida_import.sample import Sample
+from irida_import.sample_file import SampleFile
+from irida_import.sample_pair import SamplePair
+
+
+class ImportJournal:
+
+    """
+    An append-only record of an import's progress, used to resume it.
+
+    Each line of the journal is a JSON record. The first record identifies
+    the parameter file the import was started with; a journal written for a
+    different parameter file is discarded. The following records hold each
+    sample as it is resolved, the library and folder ids, and the dataset id
+    and status of every transferred file.
+    """
+
+    def __init__(self, path, params_digest):
+        """
+        Open a journal, loading any progress already recorded in it
+
+        :type path: str
+        :param path: the path of the journal file
+        :type params_digest: str
+        :param params_digest: the sha256 of the parameter file being imported
+        """
+        self.path = path
+        self.params_digest = params_digest
+        self.samples = None
+        self.resolved_samples = {}
+        self.library_id = None
+        self.folders = {}
+        self.files = {}
+        self.uploaded_files_log = []
+        self.skipped_files_log = []
+        self.history_done = False
+        self._lock = threading.Lock()
+
+        self.resumed = self._load()
+        self._handle = open(self.path, 'a' if self.resumed else 'w')
+        if not self.resumed:
+            self._write({'type': 'start', 'params': self.params_digest})
+
+    def _load(self):
+        """
+        Replay the records of an existing journal for the same parameters
+
+        :return: whether any progress was loaded
+        """
+        if not os.path.isfile(self.path):
+            return False
+
+        records = []
+        with open(self.path, 'r') as journal_fh:
+            for line in journal_fh:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # The last record was only partially written
+                    break
+
+        start = {'type': 'start', 'params': self.params_digest}
+        if not records or records[0] != start:
+            return False
+
+        for record in records[1:]:
+            self._apply(record)
+        return True
+
+    def _apply(self, record):
+        """Apply a single record to the journal's state"""
+        if record['type'] == 'sample':
+            self.resolved_samples[record['index']] = record['sample']
+        elif record['type'] == 'samples_resolved':
+            self.samples = [self.resolved_samples[index]
+                            for index in range(record['count'])]
+        elif record['type'] == 'library':
+            if self.library_id != record['id']:
+                self.folders = {}
+                self.files = {}
+                self.uploaded_files_log = []
+                self.skipped_files_log = []
+            self.library_id = record['id']
+        elif record['type'] == 'folder':
+            self.folders[record['path']] = record['id']
+        elif record['type'] == 'file':
+            self.files.setdefault(record['href'], {}).update(record)
+            if record.get('log') == 'uploaded':
+                self.uploaded_files_log.append(
+                    {'galaxy_name': record['galaxy_name']})
+            elif record.get('log') == 'skipped':
+                self.skipped_files_log.append(
+                    {'galaxy_name': record['galaxy_name']})
+        elif record['type'] == 'history':
+            self.history_done = True
+
+    def _write(self, record):
+        """Append a record to the journal, making sure it reaches the disk"""
+        with self._lock:
+            self._handle.write(json.dumps(record) + '\n')
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+
+    def close(self):
+        self._handle.close()
+
+    def get_samples(self):
+        """
+        Get the samples recorded in the journal
+
+        :return: a list of Samples, or None if no samples were recorded
+        """
+        if self.samples is None:
+            return None
+
+        return [_sample_from_dict(sample_dict) for sample_dict in self.samples]
+
+    def get_sample(self, index):
+        """
+        Get a sample recorded in the journal as it was resolved
+
+        :type index: int
+        :param index: the position of the sample in the parameter file
+        :return: a Sample, or None if the sample was not recorded
+        """
+        sample_dict = self.resolved_samples.get(index)
+        if sample_dict is None:
+            return None
+        return _sample_from_dict(sample_dict)
+
+    def restore_files(self, samples):
+        """
+        Set the dataset id and status of sample files to the ones recorded
+
+        :type samples: list
+        :param samples: the samples whose sample files to restore
+        :return: the number of sample files restored
+        """
+        restored = 0
+        for sample in samples:
+            for sample_file in _sample_files(sample):
+                file_record = self.files.get(sample_file.href)
+                if file_record is not None:
+                    sample_file.library_dataset_id = file_record['dataset_id']
+                    sample_file.ldda_id = file_record.get('ldda_id')
+                    sample_file.status = file_record['status']
+                    restored += 1
+        return restored
+
+    def record_sample(self, index, sample):
+        """
+        Record a sample as soon as it is resolved from IRIDA
+
+        :type index: int
+        :param index: the position of the sample in the parameter file
+        :type sample: Sample
+        :param sample: the resolved sample
+        """
+        record = {'type': 'sample', 'index': index,
+                  'sample': _sample_to_dict(sample)}
+        with self._lock:
+            self._apply(record)
+        self._write(record)
+
+    def record_samples_resolved(self, num_samples):
+        """
+        Record that every sample was resolved, once each of them has been
+        recorded with record_sample
+        """
+        record = {'type': 'samples_resolved', 'count': num_samples}
+        self._apply(record)
+        self._write(record)
+
+    def record_library(self, library_id):
+        """
+        Record the library being imported into. Folders and files recorded
+        for a different library are forgotten.
+        """
+        record = {'type': 'library', 'id': library_id}
+        self._apply(record)
+        self._write(record)
+
+    def record_folder(self, folder_path, folder_id):
+        """Record the id of a library folder"""
+        record = {'type': 'folder', 'path': folder_path, 'id': folder_id}
+        self._apply(record)
+        self._write(record)
+
+    def record_file(self, sample_file, galaxy_name=None, log=None):
+        """
+        Record the dataset id and status of a sample file
+
+        :type sample_file: SampleFile
+        :param sample_file: the sample file to record
+        :type galaxy_name: str
+        :param galaxy_name: the full path of the file in the library
+        :type log: str
+        :param log: 'uploaded' or 'skipped' if the file was added to the
+        uploaded or skipped files log
+        """
+        record = {
+            'type': 'file',
+            'href': sample_file.href,
+            'dataset_id': sample_file.library_dataset_id,
+            'ldda_id': sample_file.ldda_id,
+            'status': sample_file.status,
+        }
+        if galaxy_name is not None:
+            record['galaxy_name'] = galaxy_name
+        if log is not None:
+            record['log'] = log
+        with self._lock:
+            self.files.setdefault(sample_file.href, {}).update(record)
+        self._write(record)
+
+    def record_history(self):
+        """Record that the samples were added to the history"""
+        self.history_done = True
+        self._write({'type': 'history'})
+
+
+def _sample_files(sample):
+    """Get every SampleFile of a sample, including those in pairs"""
+    for sample_item in sample.get_reads():
+        if isinstance(sample_item, SamplePair):
+            yield sample_item.forward
+            yield sample_item.reverse
+        else:
+            yield sample_item
+
+
+def _sample_file_to_dict(sample_file):
+    return {
+        'name': sample_file.name,
+        'path': sample_file.path,
+        'href': sample_file.href,
+        'file_size': sample_file.file_size,
+        'upload_sha_256': sample_file.upload_sha_256,
+    }
+
+
+def _sample_to_dict(sample):
+    reads = []
+    for sample_item in sample.get_reads():
+        if isinstance(sample_item, SamplePair):
+            reads.append({
+                'pair': sample_item.name,
+                'forward': _sample_file_to_dict(sample_item.forward),
+                'reverse': _sample_file_to_dict(sample_item.reverse),
+            })
+        else:
+            reads.append(_sample_file_to_dict(sample_item))
+
+    return {
+        'name': sample.name,
+        'paired_path': sample.paired_path,
+        'unpaired_path': sample.unpaired_path,
+        'assembly_path': sample.assembly_path,
+        'fast5_path': sample.fast5_path,
+        'reads': reads,
+    }
+
+
+def _sample_from_dict(sample_dict):
+    sample = Sample(sample_dict['name'], sample_dict['paired_path'],
+                    sample_dict['unpaired_path'], sample_dict['assembly_path'],
+                    sample_dict['fast5_path'])
+    for read in sample_dict['reads']:
+        if 'pair' in read:
+            sample.add_pair(SamplePair(read['pair'],
+                                       SampleFile(**read['forward']),
+                                       SampleFile(**read['reverse'])))
+        else:
+            sample.add_file(SampleFile(**read))
+    return sample
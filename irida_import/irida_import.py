@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import contextlib
 import datetime
 import json
 import logging
@@ -9,12 +10,26 @@ import time
 import tempfile
 import shutil
 import sys
+import queue
+import threading
 import hashlib
+import http.client
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import bioblend
+import bioblend.galaxyclient
+import requests
+import urllib3
 from bioblend import galaxy
 from bioblend.galaxy.objects import GalaxyInstance
 from requests_oauthlib import OAuth2Session
 
+from irida_import.connection_pool import SessionRequests, mount_pool, pool_stats
+from irida_import.disk_cache import DownloadCache, ResponseCache
+from irida_import.import_journal import ImportJournal
+from irida_import.json_stream import JsonStream, iter_chunks
 from irida_import.sample import Sample
 from irida_import.sample_file import SampleFile
 from irida_import.sample_pair import SamplePair
@@ -27,6 +42,61 @@ os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 # Print the token so that it can be used to call the tool from the command line
 PRINT_TOKEN_INSECURELY = False
 
+class _SampleTransfers:
+
+    """
+    The transfers of one sample's files in the import pipeline, counted down
+    so that its queued files are linked once all of them are transferred
+    """
+
+    def __init__(self, num_transfers):
+        self.remaining = num_transfers
+        self.link_queue = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Count a transfer as done, returning whether it was the last one"""
+        with self._lock:
+            self.remaining -= 1
+            return self.remaining == 0
+
+
+class _PolledDataset:
+
+    """
+    A transferred sample file whose dataset the verify stage of the import
+    pipeline polls, with its own backoff
+    """
+
+    def __init__(self, sample_file, delay):
+        self.sample_file = sample_file
+        self.start = time.time()
+        self.next_poll = self.start
+        self.delay = delay
+        self.pending = True
+
+
+class _RangesNotSupported(Exception):
+
+    """IRIDA sent a whole file in reply to a request for a range of it"""
+
+
+@contextlib.contextmanager
+def _temp_dir():
+    """Make a temporary directory, removed with its files on exit"""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        yield tmp_dir
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@contextlib.contextmanager
+def _given(path):
+    """Give a path that nothing has to be held for"""
+    yield path
+
+
 class IridaImport:
 
     """
@@ -35,28 +105,100 @@ class IridaImport:
     An appropriate library and folders are created if necessary
     """
 
-    folds = {}
-
     uploaded_files_log = []
     skipped_files_log = []
 
+    # Characters of the Galaxy parameter file parsed at a time
+    PARAM_CHUNK_SIZE = 64 * 1024
+    # Where the samples are in the json_params of the parameter file
+    SAMPLES_PATH = ['_embedded', 'samples']
+
+    # IRIDA resources kept for callers asking for them again, on top of the
+    # requests in flight, see make_irida_request
+    IRIDA_REQUESTS_MEMO_SIZE = 1024
+
+    # Size of the chunks files are downloaded from IRIDA in
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+    # Items held between two stages of the import pipeline, see import_samples
+    PIPELINE_QUEUE_SIZE = 100
+    # Put into a stage's queue once every item has been put into it
+    _END_OF_STAGE = object()
+
+    # Errors that mean the connection to IRIDA dropped during a download,
+    # which is then resumed after RESUME_DELAY seconds times the number of
+    # times it was resumed
+    DROPPED_CONNECTION_ERRORS = (requests.RequestException,
+                                 urllib3.exceptions.HTTPError,
+                                 http.client.HTTPException, OSError)
+    RESUME_DELAY = 1
+
+    # Galaxy dataset states that are not final yet
+    PENDING_STATES = ['new', 'upload', 'queued', 'running', 'setting_metadata']
+    # Galaxy job states that will not change any more, other than ok
+    FAILED_JOB_STATES = ['error', 'failed', 'deleted', 'deleted_new',
+                         'stopped', 'skipped']
+    # Seconds between polls of pending datasets, doubled every round
+    POLL_INITIAL_DELAY = 1
+    POLL_MAX_DELAY = 30
+    # Seconds before trying again to delete a failed dataset, doubled every
+    # attempt
+    DELETE_RETRY_DELAY = 1
+
     def __init__(self, config):
         self.config = config
         self.logger = logging.getLogger('irida_import')
+        # Library items indexed by (type, full path), see initial_lib_state
+        self.folds = {}
+        # Records progress so an interrupted import can be resumed
+        self.journal = None
+        # Responses from IRIDA, revalidated instead of fetched again
+        self.response_cache = None
+        self.irida_user = None
+        # Files downloaded from IRIDA, kept to be uploaded again
+        self.download_cache = None
+        # IRIDA requests made during this import, by URL, least recently
+        # used first, see make_irida_request
+        self._irida_requests = OrderedDict()
+        self._irida_requests_lock = threading.Lock()
+        # Guards the file logs, which are appended to by transfer workers
+        self._log_lock = threading.Lock()
+        self._lib_lock = threading.Lock()
+        # Held while the library is listed, so that it is listed only once
+        # even when transfer workers are the first to need it
+        self._lib_state_lock = threading.Lock()
+        self._lib_state_loaded = False
 
     def initial_lib_state(self):
+        """
+        Index the current contents of the library by type and full path
 
-        if not self.folds:
-            library_info = self.reg_gi.libraries.show_library(self.library.id,contents=True)
-            for lib_item in library_info:
-                name = lib_item['name']
-                self.folds[name]={}
-                self.folds[name]['id']=lib_item['id']
-                self.folds[name]['type']=lib_item['type']
-                self.folds[name]['name']=name
+        The library is only listed by the first call. Other threads calling
+        at the same time wait until it is fully indexed.
+        """
+        with self._lib_state_lock:
+            if not self._lib_state_loaded:
+                library_info = self.reg_gi.libraries.show_library(self.library.id,contents=True)
+                for lib_item in library_info:
+                    self._index_lib_item(lib_item['type'], lib_item['name'], lib_item['id'])
+                self._lib_state_loaded = True
 
         return True
 
+    def _index_lib_item(self, item_type, name, item_id):
+        """
+        Record an item of the library in the library index
+
+        :type item_type: str
+        :param item_type: the item type e.g "folder" or "file"
+        :type name: str
+        :param name: the full path of the item e.g. '/bobfolder/bob.fastq'
+        :type item_id: str
+        :param item_id: the Galaxy id of the item
+        """
+        with self._lib_lock:
+            self.folds.setdefault((item_type, name), []).append(item_id)
+
     def get_samples(self, samples_dict, include_assemblies, include_fast5):
         """
         Gets sample objects from a dictionary.
@@ -73,60 +215,208 @@ class IridaImport:
         """
         samples = self.get_sample_meta(samples_dict)
 
-        for sample in samples:
-
-            # Add a tuple of sample_file objects for each pair
-            paired_resource = self.make_irida_request(sample.paired_path)
-            for pair in paired_resource['resources']:
-                pair_name = str(pair['identifier'])
-                for link in pair['links']:
-                    temp_link = dict()
-                    temp_link['rel'] = "self"
-                    temp_link["href"] = link['href']
-
-                    for curr_file in pair['files']:
-                        if temp_link in curr_file['links']:
-                            if link['rel'] == "pair/forward":
-                                forward = self.get_sample_file(curr_file)
-                            elif link['rel'] == "pair/reverse":
-                                reverse = self.get_sample_file(curr_file)
-
-                sample.add_pair(SamplePair(pair_name, forward, reverse))
-
-            # Add a sample_file object for each single end read
-            unpaired_resource = self.make_irida_request(sample.unpaired_path)
-            for single in unpaired_resource['resources']:
-                sample.add_file(self.get_sample_file(single['sequenceFile']))
-
-            # Add a sample_file object for each fast5
-            if sample.fast5_path and include_fast5:
-                fast5_resource = self.make_irida_request(sample.fast5_path)
-                for fast5 in fast5_resource['resources']:
-                    sample.add_file(self.get_sample_file(fast5['file']))
-
-            if include_assemblies:
-                assembly_resource = self.make_irida_request(sample.assembly_path)
-                for assembly in assembly_resource['resources']:
-                    sample.add_file(self.get_sample_file(assembly))
+        self._map_in_pool(
+            lambda sample: self._add_sample_files(
+                sample, include_assemblies, include_fast5),
+            samples,
+            self.config.MAX_IRIDA_WORKERS,
+            lambda sample: "sample '{0}'".format(sample.name),
+            host='irida')
 
         return samples
 
+    def _add_sample_files(self, sample, include_assemblies, include_fast5):
+        """
+        Resolve and add the sample files of a single sample
+
+        :type sample: Sample
+        :param sample: the sample to add pairs and files to
+        :type include_assemblies: boolean
+        :param include_assemblies: A boolean whether or not to include assemblies with the import
+        :type include_fast5: boolean
+        :param include_fast5: A boolean whether or not to include fast5 data with the import
+        :return: the sample, with its sample files added
+        """
+        # Add a tuple of sample_file objects for each pair
+        paired_resource = self.make_irida_request(sample.paired_path)
+        for pair in paired_resource['resources']:
+            pair_name = str(pair['identifier'])
+
+            # Index the pair's files by their self links
+            files_by_href = {}
+            for curr_file in pair['files']:
+                for link in curr_file['links']:
+                    if link['rel'] == 'self':
+                        files_by_href[link['href']] = curr_file
+
+            directions = {}
+            for link in pair['links']:
+                if (link['rel'] in ('pair/forward', 'pair/reverse') and
+                        link['href'] in files_by_href):
+                    directions[link['rel']] = files_by_href[link['href']]
+
+            missing = [direction for direction in ('forward', 'reverse')
+                       if 'pair/' + direction not in directions]
+            if missing:
+                raise ValueError(
+                    "Pair '{0}' of sample '{1}' has no {2} file".format(
+                        pair_name, sample.name, ' or '.join(missing)))
+
+            forward = self.get_sample_file(directions['pair/forward'])
+            reverse = self.get_sample_file(directions['pair/reverse'])
+            sample.add_pair(SamplePair(pair_name, forward, reverse))
+
+        # Add a sample_file object for each single end read
+        unpaired_resource = self.make_irida_request(sample.unpaired_path)
+        for single in unpaired_resource['resources']:
+            sample.add_file(self.get_sample_file(single['sequenceFile']))
+
+        # Add a sample_file object for each fast5
+        if sample.fast5_path and include_fast5:
+            fast5_resource = self.make_irida_request(sample.fast5_path)
+            for fast5 in fast5_resource['resources']:
+                sample.add_file(self.get_sample_file(fast5['file']))
+
+        if include_assemblies:
+            assembly_resource = self.make_irida_request(sample.assembly_path)
+            for assembly in assembly_resource['resources']:
+                sample.add_file(self.get_sample_file(assembly))
+
+        return sample
+
+    def _map_in_pool(self, func, items, max_workers, describe, host='galaxy'):
+        """
+        Call a function on every item using a bounded pool of worker threads
+
+        A failure while processing one item does not stop the other items
+        from being processed. Once every item is done, the error is raised
+        again, naming the item(s) it belongs to.
+
+        :type func: function
+        :param func: the function to call with each item
+        :type items: list
+        :param items: the items to process
+        :type max_workers: int
+        :param max_workers: the maximum number of items processed at once
+        :type describe: function
+        :param describe: returns a name for an item, used in error messages
+        :type host: str
+        :param host: 'irida' or 'galaxy', the server func mostly talks to.
+        Engines that limit concurrency per server use it to pick the limit.
+        :return: a list of results, in the same order as items
+        """
+        items = list(items)
+        results = [None] * len(items)
+        errors = []
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = [executor.submit(func, item) for item in items]
+            for index, future in enumerate(futures):
+                try:
+                    results[index] = future.result()
+                except Exception as error:
+                    errors.append((items[index], error))
+
+        self._raise_item_errors(errors, describe)
+
+        return results
+
+    def _raise_item_errors(self, errors, describe):
+        """
+        Log and raise the errors of items processed concurrently
+
+        :type errors: list
+        :param errors: tuples of each failed item and its exception
+        :type describe: function
+        :param describe: returns a name for an item, used in error messages
+        """
+        for item, error in errors:
+            self.logger.error("Failed to process {0}: {1}".format(
+                describe(item), error))
+
+        if len(errors) == 1:
+            raise errors[0][1]
+        elif errors:
+            error = "Failed to process {0} items: {1}".format(
+                len(errors), ", ".join(describe(item) for item, _ in errors))
+            raise ValueError(error)
+
     def make_irida_request(self, request_url):
         """
         Requests json object from IRIDA REST API.
 
+        Each URL is only requested once per import, as long as it is one of
+        the IRIDA_REQUESTS_MEMO_SIZE most recently used. Callers asking for a
+        URL that is already being requested wait for that request instead of
+        making their own. Failed requests are not kept, so they can be
+        retried.
+
         :type request_url: str
         :param request_url: a url to make a get request to. See IRIDA REST API
         docs for more information
         :return: a list of either single output samples(string) or paired
         output samples(tuple)
         """
-        response = self.irida.get(request_url)
+        with self._irida_requests_lock:
+            request = self._irida_requests.get(request_url)
+            owner = request is None
+            if owner:
+                request = Future()
+                self._irida_requests[request_url] = request
+            else:
+                self._irida_requests.move_to_end(request_url)
+
+        if not owner:
+            return request.result()
 
-        # Raise an exception if we get 4XX or 5XX server response
-        response.raise_for_status()
+        try:
+            resource = self._fetch_irida_resource(request_url)
+        except Exception as e:
+            with self._irida_requests_lock:
+                del self._irida_requests[request_url]
+            request.set_exception(e)
+            raise
+        request.set_result(resource)
+        with self._irida_requests_lock:
+            excess = len(self._irida_requests) - self.IRIDA_REQUESTS_MEMO_SIZE
+            if excess > 0:
+                # Requests in flight are kept for the callers waiting on them
+                for url in [url for url, done in self._irida_requests.items()
+                            if done.done()][:excess]:
+                    del self._irida_requests[url]
+        return resource
 
-        resource = response.json()['resource']
+    def _fetch_irida_resource(self, request_url):
+        """
+        Get a resource from the IRIDA REST API, revalidating the cached
+        response if there is one
+        """
+        cached = None
+        headers = {}
+        if self.response_cache is not None:
+            cached = self.response_cache.get(self.irida_user, request_url)
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        response = self.irida.get(request_url, headers=headers)
+
+        if cached is not None and response.status_code == 304:
+            body = cached['body']
+        else:
+            # Raise an exception if we get 4XX or 5XX server response
+            response.raise_for_status()
+
+            body = response.json()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if self.response_cache is not None and (etag or last_modified):
+                self.response_cache.put(self.irida_user, request_url,
+                                        etag, last_modified, body)
+
+        resource = body['resource']
         self.logger.debug("The JSON parameters from the IRIDA API are:\n" +
                           self.pp.pformat(json.dumps(dict(resource), indent=2)))
 
@@ -143,34 +433,45 @@ class IridaImport:
         :return: a list of Sample objects with it's name and paired/unpaired
         path
         """
-        samples = []
-
-        for sample_input in samples_dict:
-            sample_dir_paths = sample_input['_embedded']['sample_files']
-            sample_name = sample_input['name']
-
-            for sample_file_path in sample_dir_paths:
-                sample_path = sample_file_path['_links']['self']['href']
-
-            sample_resource = self.make_irida_request(sample_path)
-            paths = sample_resource['links']
-            paired_path = ""
-            unpaired_path = ""
-            fast5_path = ""
-            assembly_path = ""
-
-            for link in paths:
-                if link['rel'] == "sample/sequenceFiles/pairs":
-                    paired_path = link['href']
-                elif link['rel'] == "sample/sequenceFiles/unpaired":
-                    unpaired_path = link['href']
-                elif link['rel'] == "sample/assemblies":
-                    assembly_path = link['href']
-                elif link['rel'] == "sample/sequenceFiles/fast5":
-                    fast5_path = link['href']
-
-            samples.append(Sample(sample_name, paired_path, unpaired_path, assembly_path, fast5_path))
-        return samples
+        return self._map_in_pool(
+            self._get_sample_meta_item,
+            samples_dict,
+            self.config.MAX_IRIDA_WORKERS,
+            lambda sample_input: "sample '{0}'".format(sample_input['name']),
+            host='irida')
+
+    def _get_sample_meta_item(self, sample_input):
+        """
+        Gets the Sample object meta information for a single sample.
+
+        :type sample_input: dict
+        :param sample_input: a single sample entry from the samples dictionary
+        :return: a Sample object with it's name and paired/unpaired path
+        """
+        sample_dir_paths = sample_input['_embedded']['sample_files']
+        sample_name = sample_input['name']
+
+        for sample_file_path in sample_dir_paths:
+            sample_path = sample_file_path['_links']['self']['href']
+
+        sample_resource = self.make_irida_request(sample_path)
+        paths = sample_resource['links']
+        paired_path = ""
+        unpaired_path = ""
+        fast5_path = ""
+        assembly_path = ""
+
+        for link in paths:
+            if link['rel'] == "sample/sequenceFiles/pairs":
+                paired_path = link['href']
+            elif link['rel'] == "sample/sequenceFiles/unpaired":
+                unpaired_path = link['href']
+            elif link['rel'] == "sample/assemblies":
+                assembly_path = link['href']
+            elif link['rel'] == "sample/sequenceFiles/fast5":
+                fast5_path = link['href']
+
+        return Sample(sample_name, paired_path, unpaired_path, assembly_path, fast5_path)
 
     def get_sample_file(self, file_dict):
         """
@@ -262,6 +563,9 @@ class IridaImport:
             '\'%s\' from folder path \'%s\'' %
             (folder_name, base_folder_path, folder_path))
 
+        if self.journal is not None and folder_path in self.journal.folders:
+            return self.journal.folders[folder_path]
+
         exist_id = self.exists_in_lib('folder', 'name', folder_path)
 
         if not exist_id:
@@ -281,10 +585,7 @@ class IridaImport:
                               + 'folder, or nothing')
 
             #add to the current state of the library
-            self.folds[name]={}
-            self.folds[name]['id']=ans[0]['id']
-            self.folds[name]['type']='folder'
-            self.folds[name]['name']=name
+            self._index_lib_item('folder', name, ans[0]['id'])
             final_id=ans[0]['id']
 
             self.logger.debug(
@@ -294,6 +595,8 @@ class IridaImport:
             #we have no other way of knowing which one to use.
             final_id=exist_id[0]
 
+        if self.journal is not None:
+            self.journal.record_folder(folder_path, final_id)
 
         return final_id
 
@@ -304,30 +607,30 @@ class IridaImport:
         :type item_type: str
         :param item_type: the item type e.g "folder" or "file"
         :type item_attr_name: str
-        :param item_attr_name: the item attribute e.g "name"
+        :param item_attr_name: the item attribute, only "name" (the item's
+        full path) is indexed
         :type desired_attr_value: str
         :param desired_attr_value: the desired attribute value e.g "Bob"
 
         :rtype: List of Ids or Empty list
         :return: Return item unique IDs or empty list if item(s) does not exist in the library
         """
-        ans = []
+        if item_attr_name != 'name':
+            raise ValueError(
+                "Library items can only be looked up by name, not '{0}'"
+                .format(item_attr_name))
 
         # check cache before fetching from galaxy.
         # current state of the library should only change between irida_import.py invocation
-        if not self.folds:
-            self.initial_lib_state()
-
-        for item_name in self.folds:
-            if item_type == self.folds[item_name]['type']:
-                if desired_attr_value == self.folds[item_name][item_attr_name]:
-                    ans.append(self.folds[item_name]['id'])
+        self.initial_lib_state()
 
-        return ans
+        with self._lib_lock:
+            return list(self.folds.get((item_type, desired_attr_value), []))
 
 
 
-    def existing_file(self, sample_file_path, galaxy_name, size):
+    def existing_file(self, sample_file_path, galaxy_name, size,
+                      sample_file=None):
         """
         Find out dataset id for an existing file
 
@@ -340,6 +643,9 @@ class IridaImport:
         :param size: The size in bytes of the file to check against a 
         previously uploaded file. Size will be `None` if api call to 
         get sample file details does not return a value for the size
+        :type sample_file: SampleFile
+        :param sample_file: if given, the ldda id of the dataset found is
+        kept on it, so that it does not have to be looked up again
         :rtype: Boolean
         :return: Return file unique ID otherwise Boolean False
         """
@@ -352,8 +658,7 @@ class IridaImport:
 
         # check cache before fetching from galaxy.
         # current state of the library should only change between irida_import.py invocation
-        if not self.folds:
-            self.initial_lib_state()
+        self.initial_lib_state()
 
         #found all datasets with the galaxy_name
         #first attempt will assume there is only one which is not right
@@ -365,6 +670,8 @@ class IridaImport:
 
                 if item['file_size'] in (size, size + 1) and item['state'] == 'ok':
                     found = item['id']
+                    if sample_file is not None:
+                        sample_file.ldda_id = item.get('ldda_id')
                     break
 
         return found
@@ -377,35 +684,127 @@ class IridaImport:
         :param samples: the sample to verify upload
         :return: boolean indicating whether the sample was uploaded successfully
         """
-        sample_integrity_verified = sample_file.verified
+        return self.verify_samples_integrity([sample_file])[0]
 
-        if not sample_integrity_verified:
+    def verify_samples_integrity(self, sample_files):
+        """
+        Checks to see if a group of sample files were uploaded successfully
+
+        All pending datasets are polled together in rounds, backing off
+        exponentially between rounds, until every dataset has reached a
+        final state or run out of time. Each dataset may wait
+        max_waits * 5 seconds plus wait_seconds_per_gb for every GB of
+        its size. Files without a dataset, like those that failed and are
+        waiting to be transferred again, are not polled and are reported as
+        not uploaded.
+
+        :type sample_files: list
+        :param sample_files: the SampleFiles to verify upload
+        :return: a list of booleans indicating whether each sample file was
+        uploaded successfully
+        """
+        pending = self._unverified(sample_files)
+        for sample_file in pending:
             self.logger.debug(time.strftime("[%D %H:%M:%S]:") +
                               ' Verifying integrity of: ' +
                               sample_file.name)
-            num_waits = 0
-            while num_waits <= self.config.MAX_WAITS:
-                state = sample_file.state(self.reg_gi, self.library.id)
-                if state == 'ok': # uploaded succesfully
-                    self.logger.debug(time.strftime("[%D %H:%M:%S]:") + ' OK! ')
-                    sample_integrity_verified = True
-                    sample_file.verified = True
-                    break
-                elif state in ['new', 'upload', 'queued', 'running', 'setting_metadata']: # pending
-                    self.logger.debug(time.strftime("[%D %H:%M:%S]:") + ' PENDING! (%s)' % (state))
-                    num_waits += 1
-                    time.sleep(5)
-                else:
-                    self.logger.debug(time.strftime("[%D %H:%M:%S]:") + ' NOT OK! ')
-                    # delete the dataset from the library
-                    retries = 0
-                    while retries <= self.MAX_RETRIES:
-                        if sample_file.delete(self.reg_gi, self.library.id):
-                            sample_file.library_dataset_id = None
-                            break
+
+        start = time.time()
+        delay = self.POLL_INITIAL_DELAY
+
+        while pending:
+            states = self._map_in_pool(
+                lambda sample_file: sample_file.state(self.reg_gi, self.library.id),
+                pending,
+                self.config.MAX_TRANSFER_WORKERS,
+                lambda sample_file: "state of '{0}'".format(sample_file.name))
+
+            pending = [sample_file for sample_file, state in zip(pending, states)
+                       if self._check_state(sample_file, state, start)]
+            if pending:
+                time.sleep(delay)
+                delay = min(delay * 2, self.POLL_MAX_DELAY)
+
+        return [sample_file.verified for sample_file in sample_files]
+
+    def _unverified(self, sample_files):
+        """
+        The sample files whose datasets are not verified yet, leaving out
+        those without a dataset to poll
+        """
+        return [sample_file for sample_file in sample_files
+                if not sample_file.verified
+                and sample_file.library_dataset_id is not None]
+
+    def _check_state(self, sample_file, state, start):
+        """
+        Act on the polled Galaxy state of a sample file's dataset
+
+        A dataset that is ok is verified, and one that failed is deleted
+        from the library so that it is transferred again by the next retry.
+
+        :type sample_file: SampleFile
+        :param sample_file: the sample file that was polled
+        :type state: str
+        :param state: the state of its dataset
+        :type start: float
+        :param start: the time verification started at
+        :return: whether the dataset is still pending and must be polled again
+        """
+        if state == 'ok': # uploaded succesfully
+            self.logger.debug(time.strftime("[%D %H:%M:%S]:") +
+                              ' OK! (%s)' % (sample_file.name))
+            sample_file.verified = True
+            if self.journal is not None:
+                self.journal.record_file(sample_file)
+        elif state in self.PENDING_STATES: # pending
+            if time.time() - start < self._wait_budget(sample_file):
+                self.logger.debug(time.strftime("[%D %H:%M:%S]:") +
+                                  ' PENDING! (%s: %s)' % (sample_file.name, state))
+                return True
+            self.logger.debug(time.strftime("[%D %H:%M:%S]:") +
+                              ' TIMED OUT! (%s: %s)' % (sample_file.name, state))
+        else:
+            self.logger.debug(time.strftime("[%D %H:%M:%S]:") +
+                              ' NOT OK! (%s: %s)' % (sample_file.name, state))
+            # delete the dataset from the library, so it is
+            # transferred again by the next retry
+            sample_file.status = SampleFile.FAILED
+            retries = 0
+            while True:
+                try:
+                    if sample_file.delete(self.reg_gi, self.library.id):
+                        break
+                except Exception as error:
+                    self.logger.debug("Deleting dataset '%s' failed: %s"
+                                      % (sample_file.library_dataset_id, error))
+                retries += 1
+                if retries > self.config.MAX_RETRIES:
+                    self.logger.warning(
+                        "Unable to delete dataset '%s' of file '%s' from the library"
+                        % (sample_file.library_dataset_id, sample_file.name))
                     break
+                time.sleep(self.DELETE_RETRY_DELAY * 2 ** (retries - 1))
+            # transferred again even if the failed dataset is left behind
+            sample_file.library_dataset_id = None
+            if self.journal is not None:
+                self.journal.record_file(sample_file)
 
-        return sample_integrity_verified
+        return False
+
+    def _wait_budget(self, sample_file):
+        """
+        The number of seconds to wait for a sample file to finish uploading
+
+        :type sample_file: SampleFile
+        :param sample_file: the sample file being uploaded
+        :return: the number of seconds to wait
+        """
+        budget = self.config.MAX_WAITS * 5
+        if sample_file.file_size:
+            budget += (self.config.WAIT_SECONDS_PER_GB
+                       * float(sample_file.file_size) / 1024 ** 3)
+        return budget
 
     def samples_uploaded_successfully(self, samples=[]):
         """
@@ -415,71 +814,342 @@ class IridaImport:
         :param samples: the list of samples to verify upload
         :return: boolean indicating whether all of the samples were uploaded successfully
         """
-        samples_uploaded_successfully = True
+        sample_files = []
 
         # Check that samples have been added
         for sample in samples:
             for sample_item in sample.get_reads():
                 if isinstance(sample_item, SamplePair):
-                    forward_result = self.verify_sample_integrity(sample_item.forward)
-                    reverse_result = self.verify_sample_integrity(sample_item.reverse)
-                    if not forward_result or not reverse_result:
-                        samples_uploaded_successfully = False
+                    sample_files.append(sample_item.forward)
+                    sample_files.append(sample_item.reverse)
                 else:
-                    sample_result = self.verify_sample_integrity(sample_item)
-                    if not sample_result:
-                        samples_uploaded_successfully = False
+                    sample_files.append(sample_item)
 
-        return samples_uploaded_successfully
+        return all(self.verify_samples_integrity(sample_files))
 
     def add_samples_if_nec(self, samples=[]):
         """
         Uploads a list of samples if they are not already present in Galaxy
 
+        Only files that have not been transferred yet, or that failed
+        verification, are touched.
+
         :type samples: list
         :param samples: the list of samples to upload
         :return: The number of single files uploaded
         """
-        file_sum = 0
-        hist = self.histories
+        transfers = []
 
+        # Folders are created up front, one at a time, so that the
+        # library state is only changed from a single thread
         for sample in samples:
-            self.logger.debug("sample name is" + sample.name)
-            sample_root_folder_id = self.create_folder_if_nec(self.config.ILLUMINA_PATH + '/' + sample.name)
-
-            added_to_galaxy = []
-
-            for sample_item in sample.get_reads():
-                sample_folder_path = self.config.ILLUMINA_PATH + '/' + sample.name
-                if isinstance(sample_item, SamplePair):
-                    # Processing for a SamplePair
-                    forward = sample_item.forward
-                    reverse = sample_item.reverse
-                    pair_path = sample_folder_path + "/" + sample_item.name
-
-                    #since doing pair, will not be writting to the 'main' folder for the sample
-                    sample_folder_id = self.create_folder_if_nec(pair_path)
-
-                    added_to_galaxy = self._add_file(added_to_galaxy,
-                                                     pair_path,sample_folder_id,
-                                                     forward)
-
-                    file_sum += 1
+            transfers.extend(self._sample_transfers(sample))
+
+        # Download, hash and upload the files concurrently. Files that can
+        # be linked are queued and linked in batches afterwards.
+        link_queue = []
+        self._map_in_pool(
+            lambda transfer: self._add_file([], *transfer, link_queue=link_queue),
+            transfers,
+            self.config.MAX_TRANSFER_WORKERS,
+            lambda transfer: "file with Galaxy path '{0}/{1}'".format(
+                transfer[0], transfer[2].name))
+        self._link_queued(link_queue)
+
+        return len(transfers)
+
+    def _sample_transfers(self, sample):
+        """
+        Create the library folders of a sample's files that still have to be
+        transferred to Galaxy
 
-                    added_to_galaxy = self._add_file(added_to_galaxy,
-                                                     pair_path,sample_folder_id,
-                                                     reverse)
+        :type sample: Sample
+        :param sample: the sample to transfer
+        :return: a list of (Galaxy folder path, folder id, SampleFile) tuples,
+        one for each file to transfer
+        """
+        transfers = []
+        sample_items = [
+            sample_item for sample_item in sample.get_reads()
+            if self._needs_transfer(sample_item)]
+        if not sample_items:
+            return transfers
+
+        self.logger.debug("sample name is" + sample.name)
+        sample_folder_path = self.config.ILLUMINA_PATH + '/' + sample.name
+        sample_root_folder_id = self.create_folder_if_nec(sample_folder_path)
+
+        for sample_item in sample_items:
+            if isinstance(sample_item, SamplePair):
+                # Processing for a SamplePair
+                pair_path = sample_folder_path + "/" + sample_item.name
+
+                #since doing pair, will not be writting to the 'main' folder for the sample
+                sample_folder_id = self.create_folder_if_nec(pair_path)
+
+                for sample_file in (sample_item.forward, sample_item.reverse):
+                    if sample_file.needs_transfer():
+                        transfers.append((pair_path, sample_folder_id,
+                                          sample_file))
+            else:
+                # Processing for a SampleFile
+                transfers.append((sample_folder_path, sample_root_folder_id,
+                                  sample_item))
 
-                    file_sum += 1
+        return transfers
 
+    def import_samples(self, samples_source, include_assemblies, include_fast5,
+                       resolved=False):
+        """
+        Resolve samples, add their files to the library and verify them, as
+        a pipeline
+
+        Samples flow from one stage to the next through bounded queues:
+        samples are resolved against IRIDA, their library folders are
+        created, their files are transferred to Galaxy and then polled until
+        their datasets are final. Every stage works on the samples that are
+        ready for it while the stages before it carry on, so the first files
+        are transferred while most samples are still being resolved.
+
+        Each stage runs its items, and the verify stage its polls, through
+        _map_in_pool, so that the engine limits the concurrent work on each
+        server as it does everywhere else.
+
+        Errors do not stop the pipeline. Once every sample has gone through
+        it, the errors are raised again.
+
+        :type samples_source: iterable
+        :param samples_source: the sample entries of the parameter file, or
+        Samples if resolved
+        :type include_assemblies: boolean
+        :param include_assemblies: A boolean whether or not to include assemblies with the import
+        :type include_fast5: boolean
+        :param include_fast5: A boolean whether or not to include fast5 data with the import
+        :type resolved: boolean
+        :param resolved: whether the samples are already resolved
+        :return: the list of Samples, in the order of samples_source, and the
+        number of files transferred
+        """
+        resolve_inbox = queue.Queue(self.PIPELINE_QUEUE_SIZE)
+        folder_inbox = queue.Queue(self.PIPELINE_QUEUE_SIZE)
+        transfer_inbox = queue.Queue(self.PIPELINE_QUEUE_SIZE)
+        verify_inbox = queue.Queue(self.PIPELINE_QUEUE_SIZE)
+        samples = {}
+        num_files = [0]
+        errors = []
+
+        def feed():
+            try:
+                for index, sample_source in enumerate(samples_source):
+                    resolve_inbox.put((index, sample_source))
+            except Exception as error:
+                errors.append(('parameter file', error))
+            resolve_inbox.put(self._END_OF_STAGE)
+
+        def resolve(item):
+            index, sample = item
+            if not resolved:
+                journaled = None
+                if self.journal is not None:
+                    journaled = self.journal.get_sample(index)
+                if journaled is not None:
+                    sample = journaled
                 else:
-                    # Processing for a SampleFile
-                    added_to_galaxy = self._add_file(added_to_galaxy,
-                                                     sample_folder_path,sample_root_folder_id,
-                                                     sample_item)
-                    file_sum += 1
+                    sample = self._get_sample_meta_item(sample)
+                    self._add_sample_files(sample, include_assemblies,
+                                           include_fast5)
+                    # Journaled right away, so that a rerun does not ask
+                    # IRIDA about it again even if the import fails
+                    if self.journal is not None:
+                        self.journal.record_sample(index, sample)
+            samples[index] = sample
+            return [sample]
+
+        def create_folders(sample):
+            if self.journal is not None:
+                self.journal.restore_files([sample])
+            transfers = self._sample_transfers(sample)
+            num_files[0] += len(transfers)
+            sample_transfers = _SampleTransfers(len(transfers))
+            return [(transfer, sample_transfers) for transfer in transfers]
+
+        def link_queued(sample_transfers):
+            # Files queued to be linked are linked with the rest of their
+            # sample's files, once those are all transferred or failed
+            if not sample_transfers.done() or not sample_transfers.link_queue:
+                return
+            try:
+                self._link_queued(sample_transfers.link_queue)
+            except Exception as error:
+                errors.append(("linked files", error))
+            for _, _, linked in sample_transfers.link_queue:
+                if linked.library_dataset_id:
+                    verify_inbox.put(linked)
+
+        def transfer(item):
+            (folder_path, folder_id, sample_file), sample_transfers = item
+            try:
+                self._add_file([], folder_path, folder_id, sample_file,
+                               link_queue=sample_transfers.link_queue)
+            finally:
+                link_queued(sample_transfers)
+            return [sample_file] if sample_file.library_dataset_id else []
+
+        def describe_sample(item):
+            name = item[1].name if resolved else item[1]['name']
+            return "sample '{0}'".format(name)
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        stages = [
+            (resolve, resolve_inbox, folder_inbox,
+             self.config.MAX_IRIDA_WORKERS, describe_sample, 'irida'),
+            (create_folders, folder_inbox, transfer_inbox, 1,
+             lambda sample: "sample '{0}'".format(sample.name), 'galaxy'),
+            (transfer, transfer_inbox, verify_inbox,
+             self.config.MAX_TRANSFER_WORKERS,
+             lambda item: "file with Galaxy path '{0}/{1}'".format(
+                 item[0][0], item[0][2].name), 'galaxy'),
+        ]
+        workers = [self._start_stage(func, inbox, outbox, num_workers,
+                                     describe, errors, host)
+                   for func, inbox, outbox, num_workers, describe, host
+                   in stages]
+        verifier = threading.Thread(target=self._verify_stage,
+                                    args=(verify_inbox, errors))
+        verifier.start()
+
+        # Close each stage once the stage before it is done
+        feeder.join()
+        for (_, _, outbox, _, _, _), stage_workers in zip(stages, workers):
+            for worker in stage_workers:
+                worker.join()
+            outbox.put(self._END_OF_STAGE)
+        verifier.join()
+
+        self._raise_item_errors(errors, lambda description: description)
+
+        return [samples[index] for index in sorted(samples)], num_files[0]
+
+    def _start_stage(self, func, inbox, outbox, num_workers, describe, errors,
+                     host):
+        """
+        Start the worker threads of a pipeline stage
+
+        Each worker takes items from inbox, one at a time, and puts the
+        items func returns for them into outbox, until the stage before it
+        is done. func is called through _map_in_pool, so that engines that
+        limit concurrency per server apply their limit for host to it.
+
+        :type func: function
+        :param func: called with each item, returns a list of items for the
+        next stage
+        :type describe: function
+        :param describe: returns a name for an item, used in error messages
+        :type errors: list
+        :param errors: where (description, exception) tuples are added for
+        the items that failed
+        :type host: str
+        :param host: 'irida' or 'galaxy', the server func mostly talks to
+        :return: the worker threads
+        """
+        def run(item):
+            try:
+                for next_item in func(item):
+                    outbox.put(next_item)
+            except Exception as error:
+                errors.append((describe(item), error))
 
-        return file_sum
+        def work():
+            while True:
+                item = inbox.get()
+                if item is self._END_OF_STAGE:
+                    # let the other workers of the stage see it too
+                    inbox.put(item)
+                    return
+                self._map_in_pool(run, [item], 1, describe, host)
+
+        workers = [threading.Thread(target=work)
+                   for _ in range(max(1, num_workers))]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def _verify_stage(self, inbox, errors):
+        """
+        Verify the datasets of transferred sample files until they are final
+
+        Files are taken in as they are transferred, while the files that
+        arrived earlier are still being polled. Each dataset is polled with
+        its own exponential backoff and dropped once it is final, so a slow
+        dataset holds up neither the other datasets nor the transfers
+        feeding the stage.
+
+        :type inbox: queue.Queue
+        :param inbox: the transferred sample files
+        :type errors: list
+        :param errors: where (description, exception) tuples are added for
+        the files that could not be verified
+        """
+        def poll(polled):
+            sample_file = polled.sample_file
+            try:
+                state = sample_file.state(self.reg_gi, self.library.id)
+                polled.pending = self._check_state(sample_file, state,
+                                                   polled.start)
+            except Exception as error:
+                errors.append(("verification of '{0}'".format(
+                    sample_file.name), error))
+                polled.pending = False
+
+        polling = []
+        done = False
+        while polling or not done:
+            # Wait for a file, or until the next poll is due
+            timeout = None
+            if polling:
+                timeout = max(0, min(polled.next_poll for polled in polling)
+                              - time.time())
+            arrived = []
+            if done:
+                time.sleep(timeout)
+            else:
+                try:
+                    arrived.append(inbox.get(timeout=timeout))
+                except queue.Empty:
+                    pass
+                while True:
+                    try:
+                        arrived.append(inbox.get_nowait())
+                    except queue.Empty:
+                        break
+            done = done or any(item is self._END_OF_STAGE for item in arrived)
+            polling.extend(
+                _PolledDataset(sample_file, self.POLL_INITIAL_DELAY)
+                for sample_file in self._unverified(
+                    [item for item in arrived if item is not self._END_OF_STAGE]))
+
+            now = time.time()
+            due = [polled for polled in polling if polled.next_poll <= now]
+            if not due:
+                continue
+            self._map_in_pool(
+                poll, due, self.config.MAX_TRANSFER_WORKERS,
+                lambda polled: "state of '{0}'".format(polled.sample_file.name))
+            for polled in due:
+                polled.next_poll = time.time() + polled.delay
+                polled.delay = min(polled.delay * 2, self.POLL_MAX_DELAY)
+            polling = [polled for polled in polling if polled.pending]
+
+    def _needs_transfer(self, sample_item):
+        """
+        Whether a SampleFile, or either file of a SamplePair, still has to be
+        transferred to Galaxy
+        """
+        if isinstance(sample_item, SamplePair):
+            return (sample_item.forward.needs_transfer()
+                    or sample_item.reverse.needs_transfer())
+        return sample_item.needs_transfer()
 
     def add_samples_to_history(
             self, samples=[], hist_id=None, make_paired_collection=True):
@@ -493,19 +1163,22 @@ class IridaImport:
         collection_array = []
         collection_name_count = {}
         hist = self.histories
+        # Library datasets to copy into the history, and for each pair the
+        # collection name and the positions of its forward and reverse files
+        library_dataset_ids = []
+        pairs = []
+        # When building collections straight from the library, pairs are not
+        # copied into the history, the collection points at them instead
+        from_library = (make_paired_collection
+                        and self.config.COLLECTIONS_FROM_LIBRARY)
+        library_pairs = []
+
         for sample in samples:
             self.logger.debug("sample name is" + sample.name)
 
-            added_to_galaxy = []
-
             for sample_item in sample.get_reads():
-                sample_folder_path = self.config.ILLUMINA_PATH + '/' + sample.name
                 if isinstance(sample_item, SamplePair):
                     # Processing for a SamplePair
-                    datasets = dict()
-
-                    pair_path = sample_folder_path + "/" + sample_item.name
-
                     if sample.name in collection_name_count:
                         collection_name = str(sample.name) + "__" + str(collection_name_count[sample.name])
                         collection_name_count[sample.name] += 1
@@ -513,54 +1186,62 @@ class IridaImport:
                         collection_name = str(sample.name)
                         collection_name_count[sample.name] = 2
 
-                    # Add datasets to the current history
-                    datasets['forward'] = hist.upload_dataset_from_library(
-                        hist_id,
-                        sample_item.forward.library_dataset_id
-                    )['id']
-
-                    datasets['reverse'] = hist.upload_dataset_from_library(
-                        hist_id,
-                        sample_item.reverse.library_dataset_id
-                    )['id']
-
-                    if make_paired_collection:
-                        # Put datasets into the collection
-                        collection_elem_ids = [{
-                            "src": "hda",
-                            "name": "forward",
-                            "id": datasets['forward']
-                        }, {
-                            "src": "hda",
-                            "name": "reverse",
-                            "id": datasets['reverse']
-                        }]
-                        collection_array.append({
-                            'src': 'new_collection',
-                            'name': collection_name,
-                            'collection_type': 'paired',
-                            'element_identifiers': collection_elem_ids,
-                        })
-
-                        # Hide datasets in history
-                        hist.update_dataset(
-                            hist_id,
-                            datasets['forward'],
-                            visible=False
-                        )
-                        hist.update_dataset(
-                            hist_id,
-                            datasets['reverse'],
-                            visible=False
-                        )
+                    if from_library:
+                        library_pairs.append((collection_name, sample_item))
+                        continue
 
+                    pairs.append((collection_name, len(library_dataset_ids)))
+                    library_dataset_ids.append(sample_item.forward.library_dataset_id)
+                    library_dataset_ids.append(sample_item.reverse.library_dataset_id)
                 else:
                     # Processing for a SampleFile
-
-                    hist.upload_dataset_from_library(
-                        hist_id,
-                        sample_item.library_dataset_id
-                    )
+                    library_dataset_ids.append(sample_item.library_dataset_id)
+
+        # Add datasets to the current history
+        dataset_ids = self._copy_to_history(hist_id, library_dataset_ids)
+
+        if from_library:
+            self._set_ldda_ids(
+                [sample_file for _, sample_pair in library_pairs
+                 for sample_file in (sample_pair.forward, sample_pair.reverse)])
+            for collection_name, sample_pair in library_pairs:
+                collection_array.append({
+                    'src': 'new_collection',
+                    'name': collection_name,
+                    'collection_type': 'paired',
+                    'element_identifiers': [{
+                        "src": "ldda",
+                        "name": "forward",
+                        "id": sample_pair.forward.ldda_id
+                    }, {
+                        "src": "ldda",
+                        "name": "reverse",
+                        "id": sample_pair.reverse.ldda_id
+                    }],
+                })
+        elif make_paired_collection:
+            paired_dataset_ids = []
+            for collection_name, position in pairs:
+                # Put datasets into the collection
+                collection_elem_ids = [{
+                    "src": "hda",
+                    "name": "forward",
+                    "id": dataset_ids[position]
+                }, {
+                    "src": "hda",
+                    "name": "reverse",
+                    "id": dataset_ids[position + 1]
+                }]
+                collection_array.append({
+                    'src': 'new_collection',
+                    'name': collection_name,
+                    'collection_type': 'paired',
+                    'element_identifiers': collection_elem_ids,
+                })
+                paired_dataset_ids.extend(dataset_ids[position:position + 2])
+
+            # Hide datasets in history
+            self._hide_in_history(hist_id, paired_dataset_ids)
 
         if collection_array != []:
             collection_title = 'IridaImport - ' + str(datetime.datetime.now())
@@ -569,15 +1250,99 @@ class IridaImport:
                 "collection_type": "list:paired",
                 "element_identifiers": collection_array
             }
-            added_to_history = hist.create_dataset_collection(
-                hist_id,
-                collection_desc
-            )
+            if from_library:
+                # Galaxy makes the datasets of the collection from the
+                # library datasets, they must not show up in the history
+                collection_desc['type'] = 'dataset_collection'
+                collection_desc['copy_elements'] = True
+                collection_desc['hide_source_items'] = True
+                added_to_history = hist._post(
+                    collection_desc, id=hist_id, contents=True)
+            else:
+                added_to_history = hist.create_dataset_collection(
+                    hist_id,
+                    collection_desc
+                )
 
         return collection_array
 
+    def _copy_to_history(self, hist_id, library_dataset_ids):
+        """
+        Copy library datasets into a history
+
+        Galaxy copies a single library dataset per request, so the copies
+        are made concurrently.
+
+        :type hist_id: str
+        :param hist_id: the history to copy the datasets into
+        :type library_dataset_ids: list
+        :param library_dataset_ids: the library datasets to copy
+        :return: the ids of the new history datasets, in the same order
+        """
+        return self._map_in_pool(
+            lambda library_dataset_id: self.histories.upload_dataset_from_library(
+                hist_id, library_dataset_id)['id'],
+            library_dataset_ids,
+            self.config.MAX_TRANSFER_WORKERS,
+            lambda library_dataset_id: "library dataset '{0}'".format(
+                library_dataset_id))
+
+    def _set_ldda_ids(self, sample_files):
+        """
+        Look up the library dataset dataset association ids of sample files,
+        for those not already known from verifying them
+
+        :type sample_files: list
+        :param sample_files: the sample files to look up
+        """
+        def set_ldda_id(sample_file):
+            sample_file.ldda_id = self.reg_gi.libraries.show_dataset(
+                self.library.id, sample_file.library_dataset_id)['ldda_id']
+
+        self._map_in_pool(
+            set_ldda_id,
+            [sample_file for sample_file in sample_files
+             if sample_file.ldda_id is None],
+            self.config.MAX_TRANSFER_WORKERS,
+            lambda sample_file: "library dataset of '{0}'".format(
+                sample_file.name))
+
+    def _hide_in_history(self, hist_id, dataset_ids):
+        """
+        Hide datasets in a history
+
+        All of the datasets are hidden with a single batch update, falling
+        back to hiding them one at a time on Galaxy versions without it.
+
+        :type hist_id: str
+        :param hist_id: the history containing the datasets
+        :type dataset_ids: list
+        :param dataset_ids: the history datasets to hide
+        """
+        if not dataset_ids:
+            return
+
+        hist = self.histories
+        payload = {
+            'items': [{'id': dataset_id, 'history_content_type': 'dataset'}
+                      for dataset_id in dataset_ids],
+            'visible': False,
+        }
+        try:
+            hist._put(payload, url=hist._make_url(hist_id, contents=True))
+        except bioblend.ConnectionError as error:
+            self.logger.debug(
+                "Unable to hide datasets in a batch, hiding them one at a "
+                "time instead: %s" % error)
+            self._map_in_pool(
+                lambda dataset_id: hist.update_dataset(
+                    hist_id, dataset_id, visible=False),
+                dataset_ids,
+                self.config.MAX_TRANSFER_WORKERS,
+                lambda dataset_id: "history dataset '{0}'".format(dataset_id))
+
     def _add_file(self, added_to_galaxy=None, sample_folder_path=None,sample_folder_id=None,
-                  sample_file=None):
+                  sample_file=None, link_queue=None):
         """
         Upload a sample's sample files into Galaxy
 
@@ -586,61 +1351,101 @@ class IridaImport:
         get_roles
         :type sample_file: SampleFile
         :param sample_file: A file object containing the file to upload
+        :type link_queue: list
+        :param link_queue: if given, a file that would be linked is added to
+        this list to be linked later by _link_queued instead
         :return: dataset object or the id of an existing dataset
         """
         galaxy_sample_file_name = sample_folder_path + '/' + sample_file.name
-        file_exists_locally = os.path.isfile(sample_file.path)
+        local_path = self.galaxy_path(sample_file.path)
+        file_exists_locally = os.path.isfile(local_path)
+        file_log = None
 
         if sample_file.library_dataset_id is None:
-
-            #grab dataset_id if it does exist, if not will be given False
-            dataset_id = self.existing_file(
-                sample_file_path=sample_file.path, 
-                galaxy_name=galaxy_sample_file_name, 
-                size=sample_file.file_size
-            )
-
-            if dataset_id:
-                # Return dataset id of existing file
-                added_to_galaxy = [{'id': dataset_id}]
-                self.print_logged(time.strftime("[%D %H:%M:%S]:") +
-                                    ' Skipped file with Galaxy path: ' +
-                                    galaxy_sample_file_name)
-                sample_file.verified = True
-                self.skipped_files_log.append(
-                    {'galaxy_name': galaxy_sample_file_name})
-            else:
-                try:
-                    if file_exists_locally:
-                        self.logger.debug(
-                            "  Sample file does not exist so linking it")
-                        added = self.link(
-                            sample_file, sample_folder_id)
-                        if(added):
-                            added_to_galaxy = added
-                            self.print_logged(time.strftime("[%D %H:%M:%S]:") +
-                                                ' Imported file with Galaxy path: ' +
-                                                galaxy_sample_file_name)
-                            self.uploaded_files_log.append(
-                                {'galaxy_name': galaxy_sample_file_name})
-                    else:
-                        self.logger.debug(
-                                "  Sample file does not exist so uploading it")
-                        added = self.upload_file_to_galaxy(
+            sample_file.status = SampleFile.TRANSFERRING
+            try:
+                #grab dataset_id if it does exist, if not will be given False
+                dataset_id = self.existing_file(
+                    sample_file_path=local_path,
+                    galaxy_name=galaxy_sample_file_name, 
+                    size=sample_file.file_size,
+                    sample_file=sample_file
+                )
+
+                if dataset_id:
+                    # Return dataset id of existing file
+                    added_to_galaxy = [{'id': dataset_id}]
+                    self.print_logged(time.strftime("[%D %H:%M:%S]:") +
+                                        ' Skipped file with Galaxy path: ' +
+                                        galaxy_sample_file_name)
+                    sample_file.verified = True
+                    file_log = 'skipped'
+                    with self._log_lock:
+                        self.skipped_files_log.append(
+                            {'galaxy_name': galaxy_sample_file_name})
+                elif file_exists_locally and link_queue is not None:
+                    # linked later, together with the other files of its folder
+                    link_queue.append(
+                        (galaxy_sample_file_name, sample_folder_id, sample_file))
+                    return added_to_galaxy
+                else:
+                    try:
+                        if file_exists_locally:
+                            self.logger.debug(
+                                "  Sample file does not exist so linking it")
+                            added = self.link(
                                 sample_file, sample_folder_id)
-                        if(added):
-                            added_to_galaxy = added
-                            self.print_logged(time.strftime("[%D %H:%M:%S]:") +
-                                                ' Imported file with Galaxy path: ' +
-                                                galaxy_sample_file_name)
-                            self.uploaded_files_log.append(
-                                {'galaxy_name': galaxy_sample_file_name})
-                except:
-                    error = ("File not found:\n Galaxy path:{0}\nLocal path:{1}"
-                        ).format(galaxy_sample_file_name, sample_file.path)
-                    raise ValueError(error)
+                            if(added):
+                                added_to_galaxy = added
+                                self.print_logged(time.strftime("[%D %H:%M:%S]:") +
+                                                    ' Imported file with Galaxy path: ' +
+                                                    galaxy_sample_file_name)
+                                with self._log_lock:
+                                    self.uploaded_files_log.append(
+                                        {'galaxy_name': galaxy_sample_file_name})
+                        else:
+                            if self.config.TRANSFER_MODE == 'fetch':
+                                self.logger.debug(
+                                        "  Sample file does not exist so fetching it")
+                                added = self.fetch_file_to_galaxy(
+                                        sample_file, sample_folder_id)
+                            else:
+                                self.logger.debug(
+                                        "  Sample file does not exist so uploading it")
+                                added = self.upload_file_to_galaxy(
+                                        sample_file, sample_folder_id)
+                            if(added):
+                                added_to_galaxy = added
+                                self.print_logged(time.strftime("[%D %H:%M:%S]:") +
+                                                    ' Imported file with Galaxy path: ' +
+                                                    galaxy_sample_file_name)
+                                with self._log_lock:
+                                    self.uploaded_files_log.append(
+                                        {'galaxy_name': galaxy_sample_file_name})
+                    except:
+                        sample_file.status = SampleFile.FAILED
+                        error = ("File not found:\n Galaxy path:{0}\nLocal path:{1}"
+                            ).format(galaxy_sample_file_name, sample_file.path)
+                        raise ValueError(error)
 
-            sample_file.library_dataset_id = added_to_galaxy[0]['id']
+                    # add to the current state of the library
+                    self._index_lib_item('file', galaxy_sample_file_name,
+                                         added_to_galaxy[0]['id'])
+                    file_log = 'uploaded'
+
+                sample_file.library_dataset_id = added_to_galaxy[0]['id']
+            except Exception:
+                # Transferred again by the next retry, instead of being left
+                # transferring for good
+                sample_file.status = SampleFile.FAILED
+                raise
+
+        if not sample_file.verified:
+            sample_file.status = SampleFile.VERIFYING
+
+        if self.journal is not None and file_log is not None:
+            self.journal.record_file(sample_file, galaxy_sample_file_name,
+                                     file_log)
 
         return added_to_galaxy
 
@@ -657,24 +1462,154 @@ class IridaImport:
         """
         self.logger.debug('Attempting to link to file')
         added = None
-        file_path = sample_file.path
+        file_path = self.galaxy_path(sample_file.path)
         self.logger.debug(
             "       Sample file's local path is" + file_path)
-        file_type = 'auto'
-        # Assume fastq files are fastqsanger:
-        if os.path.splitext(file_path)[1] == '.fastq':
-            file_type = 'fastqsanger'
 
         added = self.reg_gi.libraries.upload_from_galaxy_filesystem(
             self.library.id,
             file_path,
             folder_id=folder_id,
             link_data_only='link_to_files',
-            file_type=file_type
+            file_type=self._file_type(file_path)
         )
 
         return added
 
+    def link_many(self, sample_files, folder_id, file_type):
+        """
+        Add several sample files to the same Galaxy folder with a single
+        request, linking to them locally
+
+        :type sample_files: list
+        :param sample_files: the sample files to link
+        :type folder_id: ID of folder to link files to
+        :param folder_id: the folder in Galaxy to store the files in
+        :type file_type: str
+        :param file_type: the Galaxy file type of all of the files
+        :return: a list containing a dict with the url, id, and name of
+        each linked file
+        """
+        self.logger.debug('Attempting to link to %d files' % len(sample_files))
+
+        # Galaxy accepts several newline separated paths in one request
+        return self.reg_gi.libraries.upload_from_galaxy_filesystem(
+            self.library.id,
+            '\n'.join(self.galaxy_path(sample_file.path)
+                      for sample_file in sample_files),
+            folder_id=folder_id,
+            link_data_only='link_to_files',
+            file_type=file_type
+        )
+
+    def _link_queued(self, link_queue):
+        """
+        Link queued sample files, batching the files bound for the same folder
+
+        :type link_queue: list
+        :param link_queue: tuples of the Galaxy path, folder id and SampleFile
+        of each file to link
+        """
+        batches = []
+        by_folder = {}
+        for queued in link_queue:
+            key = (queued[1], self._file_type(queued[2].path))
+            if key not in by_folder:
+                by_folder[key] = []
+                batches.append(by_folder[key])
+            batch = by_folder[key]
+            batch.append(queued)
+            if len(batch) == self.config.LINK_BATCH_SIZE:
+                # start a new batch for the rest of the folder's files
+                del by_folder[key]
+
+        self._map_in_pool(
+            self._link_batch,
+            batches,
+            self.config.MAX_TRANSFER_WORKERS,
+            lambda batch: "batch of {0} files linked into '{1}'".format(
+                len(batch), batch[0][0].rsplit('/', 1)[0]))
+
+    def _link_batch(self, batch):
+        """
+        Link a batch of sample files into one folder, and map the returned
+        datasets back onto the sample files
+
+        :type batch: list
+        :param batch: tuples of the Galaxy path, folder id and SampleFile of
+        each file to link, all with the same folder and file type
+        """
+        sample_files = [sample_file for _, _, sample_file in batch]
+        folder_id = batch[0][1]
+        try:
+            added = self.link_many(sample_files, folder_id,
+                                   self._file_type(sample_files[0].path))
+        except:
+            for sample_file in sample_files:
+                sample_file.status = SampleFile.FAILED
+            error = ("Unable to link files:\n Galaxy paths:{0}"
+                ).format(", ".join(galaxy_name for galaxy_name, _, _ in batch))
+            raise ValueError(error)
+
+        # Galaxy names each dataset after the file name of its path
+        datasets_by_name = {}
+        for dataset in added or []:
+            datasets_by_name.setdefault(dataset['name'], []).append(dataset)
+
+        missing = []
+        for galaxy_name, _, sample_file in batch:
+            datasets = datasets_by_name.get(
+                os.path.basename(self.galaxy_path(sample_file.path)))
+            if not datasets:
+                sample_file.status = SampleFile.FAILED
+                missing.append(galaxy_name)
+                continue
+
+            dataset_id = datasets.pop(0)['id']
+            self.print_logged(time.strftime("[%D %H:%M:%S]:") +
+                              ' Imported file with Galaxy path: ' +
+                              galaxy_name)
+            with self._log_lock:
+                self.uploaded_files_log.append({'galaxy_name': galaxy_name})
+            self._index_lib_item('file', galaxy_name, dataset_id)
+            sample_file.library_dataset_id = dataset_id
+            sample_file.status = SampleFile.VERIFYING
+            if self.journal is not None:
+                self.journal.record_file(sample_file, galaxy_name, 'uploaded')
+
+        if missing:
+            error = ("Galaxy did not return a dataset for:\n Galaxy paths:{0}"
+                ).format(", ".join(missing))
+            raise ValueError(error)
+
+    def galaxy_path(self, path):
+        """
+        Get the path a file is at on the Galaxy server, rewriting the start
+        of its IRIDA path by the longest matching path mapping
+
+        :type path: str
+        :param path: the path of the file in IRIDA
+        :return: the path of the file on the Galaxy server, or path itself if
+        no path mapping matches it
+        """
+        for irida_prefix, galaxy_prefix in self.config.PATH_MAPPINGS:
+            if path == irida_prefix or path.startswith(irida_prefix + '/'):
+                return galaxy_prefix + path[len(irida_prefix):]
+        return path
+
+    def _file_type(self, file_path):
+        """
+        The Galaxy file type to give a file
+
+        :type file_path: str
+        :param file_path: the path of the file
+        :return: 'fastqsanger' for fastq files, otherwise 'auto'
+        """
+        # Assume fastq files are fastqsanger:
+        if os.path.splitext(file_path)[1] == '.fastq':
+            return 'fastqsanger'
+        return 'auto'
+
     def upload_file_to_galaxy(self, sample_file, folder_id):
         """
         Upload a sample file to Galaxy
@@ -691,77 +1626,410 @@ class IridaImport:
         file_path = sample_file.path
         self.logger.debug(
             "       Sample file's local path is" + file_path)
-        file_type = 'auto'
-        file_ext = os.path.splitext(file_path)[1]
-
-        # Assume fastq files are fastqsanger:
-        if file_ext == '.fastq':
-            file_type = 'fastqsanger'
+        file_type = self._file_type(file_path)
 
-        tmp_dir = tempfile.mkdtemp()
-        tmp_file_mode = 'w+b'
-
-        try:
-            tmp_file = tempfile.NamedTemporaryFile(mode=tmp_file_mode, prefix=sample_file.name, dir=tmp_dir)
-            tmp_file.name = tmp_dir + "/" + sample_file.name
+        cache = self.download_cache
+        if cache is not None:
+            temp_dir = cache.temp_dir()
+        else:
+            temp_dir = _temp_dir()
+
+        with temp_dir as tmp_dir:
+            # Galaxy names the dataset after the file it is uploaded from
+            tmp_path = os.path.join(tmp_dir, sample_file.name)
+            downloaded = False
+            if cache is not None:
+                # Kept if the download is interrupted, to be resumed. Sample
+                # files sharing a URL wait for each other here, and find the
+                # file in the cache once the first is done with it.
+                partial = cache.partial(sample_file)
+            else:
+                partial = _given(tmp_path)
 
-            try:
-                headers={'Accept': sample_file.get_content_type()}
+            with partial as download_path:
+                try:
+                    if cache is not None and cache.get(sample_file, tmp_path):
+                        self.logger.debug(
+                            "       Using the cached download of " + sample_file.name)
+                    else:
+                        sha_256 = self.download_file(sample_file, download_path)
+                        if download_path != tmp_path:
+                            os.replace(download_path, tmp_path)
 
-                # Open the file for writing.
-                with open(tmp_file.name, tmp_file_mode) as f:
-                    try:
-                        # Write the content to the file
-                        with self.irida.get(sample_file.href, headers=headers, stream=False) as resp:
-                            f.write(resp.content)
-                    except:
-                        error = ("Unable to download file as it was not found:\nLocal path:{0}"
-                            ).format(sample_file.path)
-                        raise ValueError(error)
+                        if (sample_file.upload_sha_256 is not None) and (sha_256 != sample_file.upload_sha_256):
+                            error = ("Downloaded file sha256 does not match the original sha256:\nLocal path:{0}"
+                                    ).format(sample_file.path)
+                            raise ValueError(error)
+                        downloaded = True
 
-                if (sample_file.upload_sha_256 is None) or (self.check_file_hash_valid(tmp_file.name, sample_file.upload_sha_256)):
                     # Copies the file into the galaxy library
                     added = self.reg_gi.libraries.upload_file_from_local_path(
                         library_id=self.library.id,
-                        file_local_path=tmp_file.name,
+                        file_local_path=tmp_path,
                         folder_id=folder_id,
                         file_type=file_type
                     )
-                else:
-                    error = ("Downloaded file sha256 does not match the original sha256:\nLocal path:{0}"
-                            ).format(sample_file.path)
+                finally:
+                    if downloaded and cache is not None:
+                        cache.put(sample_file, tmp_path)
+
+        return added
+
+    def fetch_file_to_galaxy(self, sample_file, folder_id):
+        """
+        Have Galaxy fetch a sample file straight from IRIDA
+
+        Galaxy is sent the IRIDA URL of the file along with the IRIDA access
+        token of this import, so the file crosses the network once and never
+        touches the disk of the tool. Galaxy checks the file against its
+        uploadSha256.
+
+        IRIDA cannot issue a token for a single file, so the token of the
+        whole import is sent. Galaxy keeps the request, token included, in
+        the parameters of the fetch job, where Galaxy admins can read it
+        until the token expires.
+
+        :type sample_file: SampleFile
+        :param sample_file: the sample file to fetch
+        :type folder_id: ID of folder to fetch file to
+        :param folder_id: the folder in Galaxy to store the file in
+        :return: a list containing a single dict with the file's
+        id and name.
+        """
+        self.logger.debug('Attempting to fetch file')
+        payload = {
+            'targets': [{
+                'destination': {'type': 'library_folder',
+                                'library_folder_id': folder_id},
+                'items': [self._fetch_item(sample_file)],
+            }],
+        }
+        fetched = self.reg_gi.make_post_request(
+            self.reg_gi.url + '/tools/fetch', payload=payload)
+
+        ldda_ids = []
+        for job in fetched.get('jobs', []):
+            job = self._wait_for_job(job['id'], sample_file)
+            ldda_ids.extend(output['id'] for output in job.get('outputs', {}).values()
+                            if output.get('src') == 'ldda')
+        if len(ldda_ids) != 1:
+            error = ("Galaxy created {0} datasets fetching the file:\nLocal path:{1}"
+                ).format(len(ldda_ids), sample_file.path)
+            raise ValueError(error)
+
+        return self._find_folder_dataset(folder_id, sample_file, ldda_ids[0])
+
+    def _fetch_item(self, sample_file):
+        """
+        Describe a sample file as an item of a Galaxy fetch request
+
+        :type sample_file: SampleFile
+        :param sample_file: the sample file Galaxy is to fetch
+        :return: a dict of the item
+        """
+        item = {
+            'src': 'url',
+            'url': sample_file.href,
+            'name': sample_file.name,
+            'ext': self._file_type(sample_file.path),
+            'headers': {
+                'Authorization': 'Bearer ' + self.irida.token['access_token'],
+                'Accept': sample_file.get_content_type(),
+            },
+        }
+        if sample_file.upload_sha_256 is not None:
+            item['hashes'] = [{'hash_function': 'SHA-256',
+                               'hash_value': sample_file.upload_sha_256}]
+        return item
+
+    def _wait_for_job(self, job_id, sample_file):
+        """
+        Wait for the Galaxy job fetching a sample file to finish
+
+        :type job_id: str
+        :param job_id: the id of the job
+        :type sample_file: SampleFile
+        :param sample_file: the sample file the job is fetching
+        :return: the finished job
+        """
+        start = time.time()
+        delay = self.POLL_INITIAL_DELAY
+        while True:
+            job = self.reg_gi.jobs.show_job(job_id)
+            state = job['state']
+            if state == 'ok':
+                return job
+            if state in self.FAILED_JOB_STATES:
+                error = ("Galaxy was unable to fetch the file:\nLocal path:{0}\nJob state:{1}"
+                    ).format(sample_file.path, state)
+                raise ValueError(error)
+            if time.time() - start >= self._wait_budget(sample_file):
+                error = ("Timed out waiting for Galaxy to fetch the file:\nLocal path:{0}"
+                    ).format(sample_file.path)
+                raise ValueError(error)
+            time.sleep(delay)
+            delay = min(delay * 2, self.POLL_MAX_DELAY)
+
+    def _find_folder_dataset(self, folder_id, sample_file, ldda_id):
+        """
+        Find the library dataset a fetch job created in a library folder
+
+        Fetch jobs name the dataset association they created, but the
+        library refers to datasets by their library dataset id, which is
+        looked up among the folder's datasets named after the sample file.
+
+        :type folder_id: str
+        :param folder_id: the folder in Galaxy to look in
+        :type sample_file: SampleFile
+        :param sample_file: the sample file that was fetched
+        :type ldda_id: str
+        :param ldda_id: the id of the dataset association the job created
+        :return: a list containing a single dict with the dataset's id and
+        name
+        """
+        contents = self.reg_gi.make_get_request(
+            self.reg_gi.url + '/folders/' + folder_id + '/contents',
+            params={'search_text': sample_file.name}).json()['folder_contents']
+        for item in contents:
+            if item['type'] == 'file' and item.get('ldda_id') == ldda_id:
+                sample_file.ldda_id = ldda_id
+                return [{'id': item['id'], 'name': item['name']}]
+
+        error = ("Galaxy did not add the fetched file to its folder:\nLocal path:{0}"
+            ).format(sample_file.path)
+        raise ValueError(error)
+
+    def download_file(self, sample_file, file_path):
+        """
+        Download a sample file from IRIDA, streaming it to disk
+
+        A file already at file_path is taken to be the start of the sample
+        file, left there by an interrupted download, and only the rest of
+        the sample file is requested with an HTTP Range request. Downloads
+        are resumed the same way when the connection to IRIDA drops, up to
+        max_download_resumes times. The downloaded file must have the size
+        IRIDA gave for it.
+
+        The sha256 of the file is computed as it is downloaded, but only if
+        IRIDA provided an uploadSha256 to check it against.
+
+        :type sample_file: SampleFile
+        :param sample_file: the sample file to download
+        :type file_path: str
+        :param file_path: the local path to write the file to
+        :return: the sha256 hex digest of the downloaded file, or None if
+        the sample file has no uploadSha256
+        """
+        sha256 = None
+        if sample_file.upload_sha_256 is not None:
+            sha256 = hashlib.sha256()
+
+        offset = 0
+        if os.path.isfile(file_path):
+            offset = os.path.getsize(file_path)
+            if sample_file.file_size is not None and offset > sample_file.file_size:
+                offset = 0
+
+        if (not offset and sample_file.file_size is not None and
+                self.config.DOWNLOAD_SEGMENTS > 1 and
+                sample_file.file_size >= self.config.SEGMENTED_DOWNLOAD_MIN_BYTES):
+            try:
+                return self._download_segmented(sample_file, file_path)
+            except _RangesNotSupported:
+                self.logger.debug("IRIDA does not support range requests, "
+                                  "downloading {0} in one piece"
+                                  .format(sample_file.name))
+
+        # Open the file for writing, keeping what was already downloaded
+        with open(file_path, 'r+b' if offset else 'wb') as f:
+            if offset:
+                self.logger.debug("Resuming the download of {0} at {1} bytes"
+                                  .format(sample_file.name, offset))
+                if sha256 is not None:
+                    self._hash_file(f, offset, sha256)
+                f.seek(offset)
+                f.truncate()
+
+            resumes = 0
+            while True:
+                offset = f.tell()
+                headers = {'Accept': sample_file.get_content_type()}
+                if offset:
+                    headers['Range'] = 'bytes={0}-'.format(offset)
+
+                try:
+                    # Write the content to the file as it arrives
+                    with self.irida.get(sample_file.href, headers=headers,
+                                        stream=True) as resp:
+                        if offset and resp.status_code == 416:
+                            # Nothing is left past the end of the file
+                            break
+                        resp.raise_for_status()
+                        if offset and resp.status_code != 206:
+                            # The whole file was sent, instead of the range
+                            f.seek(0)
+                            f.truncate()
+                            if sha256 is not None:
+                                sha256 = hashlib.sha256()
+                        self._write_response(resp, f, sha256)
+                    if (sample_file.file_size is None or
+                            f.tell() >= sample_file.file_size):
+                        break
+                except requests.HTTPError:
+                    resumes = self.config.MAX_DOWNLOAD_RESUMES
+                except self.DROPPED_CONNECTION_ERRORS as error:
+                    self.logger.debug("Download of {0} dropped at {1} bytes: {2}"
+                                      .format(sample_file.name, f.tell(), error))
+
+                resumes += 1
+                if resumes > self.config.MAX_DOWNLOAD_RESUMES:
+                    error = ("Unable to download file as it was not found:\nLocal path:{0}"
+                        ).format(sample_file.path)
                     raise ValueError(error)
-            except ValueError as content_type_error:
-                raise ValueError(content_type_error)
+                time.sleep(self.RESUME_DELAY * resumes)
 
-            # closes and removes the temp file
-            tmp_file.close()
-        finally:
-            # Remove the temp directory
-            shutil.rmtree(tmp_dir)
+            size = f.tell()
 
-        return added
+        if sample_file.file_size is not None and size != sample_file.file_size:
+            os.remove(file_path)
+            error = ("Downloaded file size {0} does not match the original size {1}:\nLocal path:{2}"
+                ).format(size, sample_file.file_size, sample_file.path)
+            raise ValueError(error)
+
+        if sha256 is None:
+            return None
+        return sha256.hexdigest()
 
-    def check_file_hash_valid(self, temp_file_path, expected_sha_256):
+    def _download_segmented(self, sample_file, file_path):
         """
-        Check if the downloaded file sha256 matches the original uploaded file sha256
+        Download a large sample file as several byte ranges at once
 
-        :type temp_file_path: Temporary file
-        :param temp_file_path: the downloaded file path
-        :type expected_sha_256: str
-        :param expected_sha_256: the original uploaded file sha256
-        :return: if the downloaded file sha256 matches the original uploaded file sha256
-        url, id, and name.
+        Each range is fetched over its own connection and written at its
+        offset in a file preallocated to the sample file's size, next to
+        file_path. The file is moved to file_path and hashed once every
+        range is written, and removed if any range fails, so that a
+        partly written file is never taken for a partial download.
+
+        :type sample_file: SampleFile
+        :param sample_file: the sample file to download, whose size is known
+        :type file_path: str
+        :param file_path: the local path to write the file to
+        :return: the sha256 hex digest of the downloaded file, or None if
+        the sample file has no uploadSha256
+        :raises _RangesNotSupported: if IRIDA sends the whole file instead of
+        a range of it
         """
-        BUF_SIZE = 32768 # Read file in 32kb chunks
+        size = sample_file.file_size
+        num_segments = self.config.DOWNLOAD_SEGMENTS
+        segment_size = -(-size // num_segments)
+        segments = [(start, min(start + segment_size, size) - 1)
+                    for start in range(0, size, segment_size)]
+        self.logger.debug("Downloading {0} in {1} segments".format(
+            sample_file.name, len(segments)))
+
+        segments_path = file_path + '.segments'
+        try:
+            # Sparse where the file system allows it
+            with open(segments_path, 'wb') as f:
+                f.truncate(size)
+
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                futures = [executor.submit(self._download_segment, sample_file,
+                                           segments_path, start, end)
+                           for start, end in segments]
+                for future in futures:
+                    future.result()
+            os.replace(segments_path, file_path)
+        except BaseException:
+            os.remove(segments_path)
+            raise
+
+        if sample_file.upload_sha_256 is None:
+            return None
         sha256 = hashlib.sha256()
-        with open(temp_file_path, 'rb') as f:
-            while True:
-                data = f.read(BUF_SIZE)
-                if not data:
+        with open(file_path, 'rb') as f:
+            self._hash_file(f, size, sha256)
+        return sha256.hexdigest()
+
+    def _download_segment(self, sample_file, file_path, start, end):
+        """
+        Download the bytes start to end, inclusive, of a sample file into
+        the same place in a preallocated file, resuming the range when the
+        connection drops
+        """
+        headers = {'Accept': sample_file.get_content_type()}
+        position = start
+        resumes = 0
+        with open(file_path, 'r+b') as f:
+            while position <= end:
+                headers['Range'] = 'bytes={0}-{1}'.format(position, end)
+                f.seek(position)
+                try:
+                    with self.irida.get(sample_file.href, headers=headers,
+                                        stream=True) as resp:
+                        resp.raise_for_status()
+                        if resp.status_code != 206:
+                            raise _RangesNotSupported()
+                        self._write_response(resp, f)
+                except self.DROPPED_CONNECTION_ERRORS as error:
+                    if isinstance(error, requests.HTTPError):
+                        resumes = self.config.MAX_DOWNLOAD_RESUMES
+                    self.logger.debug("Download of {0} dropped at {1} bytes: {2}"
+                                      .format(sample_file.name, f.tell(), error))
+                position = f.tell()
+                if position > end:
                     break
-                sha256.update(data)
-        return sha256.hexdigest() == expected_sha_256
+
+                resumes += 1
+                if resumes > self.config.MAX_DOWNLOAD_RESUMES:
+                    error = ("Unable to download file as it was not found:\nLocal path:{0}"
+                        ).format(sample_file.path)
+                    raise ValueError(error)
+                time.sleep(self.RESUME_DELAY * resumes)
+
+    def _hash_file(self, f, size, sha256):
+        """Hash the first size bytes of an open file"""
+        buf = bytearray(self.DOWNLOAD_CHUNK_SIZE)
+        view = memoryview(buf)
+        f.seek(0)
+        while size:
+            num_read = f.readinto(view[:min(size, len(buf))])
+            if not num_read:
+                break
+            sha256.update(view[:num_read])
+            size -= num_read
+
+    def _write_response(self, resp, f, sha256=None):
+        """
+        Write a streamed response body to a file in fixed-size chunks
+
+        A single buffer is reused for every chunk, so memory use does not
+        depend on the size of the file.
+
+        :type resp: requests.Response
+        :param resp: a response opened with stream=True
+        :type f: file
+        :param f: the open file to write to
+        :type sha256: hashlib.sha256
+        :param sha256: if given, updated with every chunk that is written
+        :return: the number of bytes written
+        """
+        buf = bytearray(self.DOWNLOAD_CHUNK_SIZE)
+        view = memoryview(buf)
+        written = 0
+
+        # Let urllib3 undo any gzip/deflate transfer encoding
+        resp.raw.decode_content = True
+        while True:
+            num_read = resp.raw.readinto(buf)
+            if not num_read:
+                break
+            f.write(view[:num_read])
+            if sha256 is not None:
+                sha256.update(view[:num_read])
+            written += num_read
+
+        return written
 
     def print_summary(self, failed=False):
         """
@@ -792,6 +2060,18 @@ class IridaImport:
         self.logger.info(message)
         print(message)
 
+    def log_connection_stats(self):
+        """Log how many connections were opened to IRIDA and Galaxy"""
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+
+        for service, session in (('IRIDA', self.irida),
+                                 ('Galaxy', self.galaxy_session)):
+            for host, num_connections, num_requests in pool_stats(session):
+                self.logger.debug(
+                    "{0} ({1}): {2} requests over {3} connections".format(
+                        service, host, num_requests, num_connections))
+
     def get_IRIDA_session(self, oauth_dict):
         """
         Create an OAuth2 session with IRIDA
@@ -816,6 +2096,26 @@ class IridaImport:
 
 
 
+    def _json_params(self, param_file_handle):
+        """
+        Stream the json_params of a Galaxy parameter file
+
+        :type param_file_handle: file
+        :param param_file_handle: the parameter file, read from the start
+        :return: a JsonStream of the json_params, which Galaxy stores in the
+        parameter file as a string
+        """
+        param_stream = JsonStream(
+            iter_chunks(param_file_handle, self.PARAM_CHUNK_SIZE))
+        return JsonStream(param_stream.iter_string(['param_dict', 'json_params']))
+
+    def _iter_param_samples(self, json_parameter_file):
+        """Iterate over the samples of a Galaxy parameter file, one at a time"""
+        with open(json_parameter_file, 'r') as param_file_handle:
+            for sample_input in self._json_params(param_file_handle).iter_items(
+                    self.SAMPLES_PATH):
+                yield sample_input
+
     def import_to_galaxy(self, json_parameter_file, log, hist_id, token=None,
                          config_file=None):
         """
@@ -832,23 +2132,44 @@ class IridaImport:
         :type config_file: str
         :param config_file: the name of a file to configure from
         """
+        # bioblend opens a new connection for every request, so both
+        # Galaxy clients send their requests over one pooled session,
+        # shared by the folder, transfer and verify stages at once. bioblend
+        # only sends requests through its requests module, which is put back
+        # once the import is done.
+        self.galaxy_session = mount_pool(
+            requests.Session(), 2 * self.config.MAX_TRANSFER_WORKERS + 1)
+        original_requests = bioblend.galaxyclient.requests
+        bioblend.galaxyclient.requests = SessionRequests(self.galaxy_session)
+        try:
+            return self._import_to_galaxy(json_parameter_file, log, hist_id,
+                                          token, config_file)
+        finally:
+            bioblend.galaxyclient.requests = original_requests
+            # Resources may have changed by the next import
+            self._irida_requests.clear()
+
+    def _import_to_galaxy(self, json_parameter_file, log, hist_id, token,
+                          config_file):
+        """Import samples into Galaxy, see import_to_galaxy"""
         collection_array = []
         num_files = 0
         self.pp = pprint.PrettyPrinter(indent=4)
 
         self.logger.setLevel(logging.INFO)
+        self._irida_requests.clear()
         with open(json_parameter_file, 'r') as param_file_handle:
 
-            full_param_dict = json.loads(param_file_handle.read())
-            param_dict = full_param_dict['param_dict']
-            json_params_dict = json.loads(param_dict['json_params'])
+            # The samples are left out, and read one at a time later on
+            json_params_dict = self._json_params(param_file_handle).load(
+                skip=self.SAMPLES_PATH)
 
             self.print_logged("Importing files from IRIDA to Galaxy...")
 
             self.uploaded_files_log = []
             self.skipped_files_log = []
 
-            samples_dict = json_params_dict['_embedded']['samples']
+            samples_dict = self._iter_param_samples(json_parameter_file)
             email = json_params_dict['_embedded']['user']['email']
             addtohistory = json_params_dict['_embedded']['addtohistory']
             
@@ -872,6 +2193,20 @@ class IridaImport:
 
             self.token = token
             self.irida = self.get_IRIDA_session(oauth_dict)
+            self.irida_user = email
+            if self.config.DOWNLOAD_CACHE_DIR:
+                self.download_cache = DownloadCache(
+                    self.config.DOWNLOAD_CACHE_DIR,
+                    self.config.DOWNLOAD_CACHE_MAX_GB * 1024 ** 3)
+            if self.config.RESPONSE_CACHE_DIR:
+                self.response_cache = ResponseCache(
+                    self.config.RESPONSE_CACHE_DIR,
+                    self.config.RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+            # Metadata workers and transfer workers, with a connection per
+            # download segment, all talk to IRIDA
+            mount_pool(self.irida, self.config.MAX_IRIDA_WORKERS +
+                       self.config.MAX_TRANSFER_WORKERS *
+                       max(1, self.config.DOWNLOAD_SEGMENTS))
 
             self.gi = GalaxyInstance(self.config.GALAXY_URL, self.config.ADMIN_KEY)
             self.gi.gi.max_get_attempts = self.config.MAX_CLIENT_ATTEMPTS
@@ -888,26 +2223,53 @@ class IridaImport:
 
             self.histories = self.reg_gi.histories
 
-            # Each sample contains a list of sample files
-            samples = self.get_samples(samples_dict, include_assemblies, include_fast5)
+            if log:
+                param_file_handle.seek(0)
+                params_digest = hashlib.sha256()
+                for chunk in iter_chunks(param_file_handle, self.PARAM_CHUNK_SIZE):
+                    params_digest.update(chunk.encode('utf-8'))
+                self.journal = ImportJournal(
+                    log + '.journal', params_digest.hexdigest())
 
             # Set up the library
             self.library = self.get_first_or_make_lib(desired_lib_name, email)
+            if self.journal is not None:
+                self.journal.record_library(self.library.id)
+                self.uploaded_files_log = list(self.journal.uploaded_files_log)
+                self.skipped_files_log = list(self.journal.skipped_files_log)
             self.create_folder_if_nec(self.config.ILLUMINA_PATH)
             self.create_folder_if_nec(self.config.REFERENCE_PATH)
 
-            # Add each sample's files to the library
-            retries = 0
-            while (retries <= self.config.MAX_RETRIES):
-                num_files = self.add_samples_if_nec(samples)
+            # Each sample contains a list of sample files
+            samples = None
+            if self.journal is not None:
+                samples = self.journal.get_samples()
+            if samples is None:
+                samples, num_files = self.import_samples(
+                    samples_dict, include_assemblies, include_fast5)
+                if self.journal is not None:
+                    self.journal.record_samples_resolved(len(samples))
+            else:
+                self.print_logged("Resuming the import from " + self.journal.path)
+                samples, num_files = self.import_samples(
+                    samples, include_assemblies, include_fast5, resolved=True)
 
-                self.logger.debug(time.strftime("[%D %H:%M:%S]:") + ' Checking if Samples uploaded successfully! ')
-                if self.samples_uploaded_successfully(samples):
+            # Retry only the files that failed
+            retries = 0
+            self.logger.debug(time.strftime("[%D %H:%M:%S]:") + ' Checking if Samples uploaded successfully! ')
+            while not self.samples_uploaded_successfully(samples):
+                retries += 1
+                if retries > self.config.MAX_RETRIES:
                     break
-                else:
-                    retries += 1
+                delay = self.config.RETRY_DELAY * 2 ** (retries - 1)
+                self.logger.debug(time.strftime("[%D %H:%M:%S]:") +
+                                  ' Retrying failed files in %s seconds' % delay)
+                time.sleep(delay)
+                num_files = self.add_samples_if_nec(samples)
 
-            if addtohistory:
+            if addtohistory and self.journal is not None and self.journal.history_done:
+                self.print_logged("Samples were already added to history!")
+            elif addtohistory:
                 if make_paired_collection:
                     collection_array = self.add_samples_to_history(samples, hist_id)
                     self.print_logged("Samples added to history!")
@@ -917,9 +2279,15 @@ class IridaImport:
                     collection_array = self.add_samples_to_history(
                         samples, hist_id, make_paired_collection=False)
                     self.print_logged("Samples added to history!")
+                if self.journal is not None:
+                    self.journal.record_history()
             else:
                 self.print_logged("Samples not added to history!")
 
             self.logger.debug("Number of files on galaxy: " + str(num_files))
 
+            if self.journal is not None:
+                self.journal.close()
+
+            self.log_connection_stats()
             self.print_summary()
@@ -0,0 +1,246 @@
+"""
+Copyright Government of Canada 2015-2020
+
+Written by: National Microbiology Laboratory, Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import json
+import re
+
+_decoder = json.JSONDecoder()
+
+_WHITESPACE = ' \t\n\r'
+# Characters that carry a number on past its integer part
+_NUMBER_PARTS = '.eE+-'
+
+# The characters and complete escapes that make up the body of a string
+_STRING_BODY = re.compile(r'(?:[^"\\]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*')
+# An escaped high surrogate, which must be decoded with the escape after it
+_HIGH_SURROGATE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}$')
+
+
+class JsonStream:
+
+    """
+    Parses a JSON document from an iterable of text chunks, holding no more
+    of the document in memory than the value being read.
+
+    A stream is read once, from start to end: each of iter_items, iter_string
+    and load can be called once per stream.
+    """
+
+    def __init__(self, chunks):
+        """
+        :type chunks: iterable
+        :param chunks: the text of the document, in chunks of any size
+        """
+        self._chunks = iter(chunks)
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """
+        Read the next chunk, dropping the text that was already parsed
+
+        :return: False if there are no more chunks
+        """
+        if self._eof:
+            return False
+        for chunk in self._chunks:
+            if chunk:
+                self._buf = self._buf[self._pos:] + chunk
+                self._pos = 0
+                return True
+        self._eof = True
+        return False
+
+    def _peek(self):
+        """Get the next character that is not whitespace, without parsing it"""
+        while True:
+            while (self._pos < len(self._buf) and
+                   self._buf[self._pos] in _WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON document')
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError("Expected '{0}' in JSON document, found '{1}'"
+                             .format(char, found))
+        self._pos += 1
+
+    def _decode(self):
+        """Decode the next value as a whole"""
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the text read so far, or cut off at
+            # its fraction or exponent, may go on in the next chunk
+            if (end == len(self._buf) or
+                    (_is_number(value) and self._buf[end] in _NUMBER_PARTS)):
+                if self._fill():
+                    continue
+            self._pos = end
+            return value
+
+    def _keys(self):
+        """
+        Iterate over the keys of the next object. The value of each key must
+        be parsed before asking for the next key.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._decode()
+            self._expect(':')
+            yield key
+            if self._peek() == '}':
+                self._pos += 1
+                return
+            self._expect(',')
+
+    def _elements(self):
+        """
+        Iterate over the elements of the next array. Each element must be
+        parsed before asking for the next one.
+        """
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self._peek() == ']':
+                self._pos += 1
+                return
+            self._expect(',')
+
+    def _skip(self):
+        """Parse the next value without keeping it"""
+        char = self._peek()
+        if char == '{':
+            for _ in self._keys():
+                self._skip()
+        elif char == '[':
+            for _ in self._elements():
+                self._skip()
+        else:
+            self._decode()
+
+    def _find(self, path):
+        """Parse up to the value at path, a list of object keys"""
+        for key in path:
+            for found in self._keys():
+                if found == key:
+                    break
+                self._skip()
+            else:
+                raise KeyError(key)
+
+    def iter_items(self, path):
+        """
+        Iterate over the elements of the array at path, decoding one element
+        at a time
+
+        :type path: list
+        :param path: the object keys leading to the array
+        """
+        self._find(path)
+        for _ in self._elements():
+            yield self._decode()
+
+    def iter_string(self, path):
+        """
+        Iterate over the text of the string at path, unescaped in chunks
+
+        :type path: list
+        :param path: the object keys leading to the string
+        """
+        self._find(path)
+        self._expect('"')
+        while True:
+            end = _STRING_BODY.match(self._buf, self._pos).end()
+            if end < len(self._buf) and self._buf[end] == '"':
+                yield json.loads('"' + self._buf[self._pos:end] + '"')
+                self._pos = end + 1
+                return
+
+            if end < len(self._buf) and len(self._buf) - end >= 6:
+                raise ValueError('Invalid escape in JSON string')
+            if self._ends_in_high_surrogate(end):
+                end -= 6
+            if end > self._pos:
+                yield json.loads('"' + self._buf[self._pos:end] + '"')
+                self._pos = end
+            if not self._fill():
+                raise ValueError('Unterminated string in JSON document')
+
+    def _ends_in_high_surrogate(self, end):
+        """Whether the string body up to end ends in an escaped high surrogate"""
+        match = _HIGH_SURROGATE.search(self._buf, self._pos, end)
+        if match is None:
+            return False
+        # The backslash must start an escape, not end an escaped backslash
+        start = match.start()
+        backslashes = 0
+        while (start - backslashes > self._pos and
+               self._buf[start - backslashes - 1] == '\\'):
+            backslashes += 1
+        return backslashes % 2 == 0
+
+    def load(self, skip=None):
+        """
+        Decode the document, leaving out the elements of one array
+
+        :type skip: list
+        :param skip: the object keys leading to an array that is replaced by
+        an empty list, or None to decode the whole document
+        :return: the decoded document
+        """
+        return self._load(list(skip) if skip else None)
+
+    def _load(self, skip):
+        if not skip or self._peek() != '{':
+            return self._decode()
+
+        loaded = {}
+        for key in self._keys():
+            if key != skip[0]:
+                loaded[key] = self._decode()
+            elif len(skip) == 1:
+                self._skip()
+                loaded[key] = []
+            else:
+                loaded[key] = self._load(skip[1:])
+        return loaded
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def iter_chunks(file_handle, chunk_size):
+    """Iterate over the text of a file in chunks of chunk_size characters"""
+    return iter(lambda: file_handle.read(chunk_size), '')
@@ -53,6 +53,11 @@ if __name__ == '__main__':
     parser.add_argument(
         '-i', '--history-id', dest='hist_id', default=False,
         help='The tool requires a History ID.')
+    parser.add_argument(
+        '-e', '--engine', dest='engine', default='threads',
+        choices=['threads', 'asyncio'],
+        help='The engine that runs the import. "threads" uses pools of worker '
+             + 'threads, "asyncio" drives all of the work from one event loop.')
 
     args = parser.parse_args()
     if len(sys.argv) == 1:
@@ -83,7 +88,11 @@ if __name__ == '__main__':
         # after the tool xml is generated galaxy will install all the required dependencies
         from irida_import.irida_import import IridaImport
 
-        importer = IridaImport(config)
+        if args.engine == 'asyncio':
+            from irida_import.async_irida_import import AsyncIridaImport
+            importer = AsyncIridaImport(config)
+        else:
+            importer = IridaImport(config)
         # otherwise start looking at the input file
         try:
             file_to_open = args.json_parameter_file
@@ -20,6 +20,10 @@ class Sample:
 
     """A representation of a sample obtained from IRIDA"""
 
+    # Slots keep large imports small; there is one Sample per IRIDA sample
+    __slots__ = ('name', 'paired_path', 'unpaired_path', 'assembly_path',
+                 'fast5_path', '_sample_reads')
+
     def __init__(self, name, paired_path, unpaired_path, assembly_path, fast5_path):
         """
         Initialize a sample instance
@@ -20,6 +20,19 @@ class SampleFile:
 
     """A representation of a sample file obtained from IRIDA"""
 
+    # Slots keep large imports small; there is one SampleFile per file
+    __slots__ = ('path', 'name', 'href', 'file_size', 'upload_sha_256',
+                 'library_dataset_id', 'ldda_id', 'status')
+
+    # The states a sample file goes through while it is imported:
+    # pending -> transferring -> verifying -> ok, or failed when the
+    # upload is rejected by Galaxy and the file must be transferred again
+    PENDING = 'pending'
+    TRANSFERRING = 'transferring'
+    VERIFYING = 'verifying'
+    OK = 'ok'
+    FAILED = 'failed'
+
     def __init__(self, name, path, href, file_size=None, upload_sha_256=None):
         """
         Create a sample file instance.
@@ -42,7 +55,10 @@ class SampleFile:
         self.file_size = file_size
         self.upload_sha_256 = upload_sha_256
         self.library_dataset_id = None
-        self.verified = False
+        # The id of the library dataset's dataset association, which
+        # collections can be built from
+        self.ldda_id = None
+        self.status = SampleFile.PENDING
 
     def __eq__(self, sample_file):
         equal = False
@@ -58,8 +74,26 @@ class SampleFile:
     def __repr__(self):
         return self.name + " @ " + self.path + " @ " + self.href
 
+    @property
+    def verified(self):
+        """Whether the file is known to be uploaded to Galaxy successfully"""
+        return self.status == SampleFile.OK
+
+    @verified.setter
+    def verified(self, verified):
+        if verified:
+            self.status = SampleFile.OK
+        elif self.status == SampleFile.OK:
+            self.status = SampleFile.PENDING
+
+    def needs_transfer(self):
+        """Whether the file still has to be transferred to Galaxy"""
+        return self.status in (SampleFile.PENDING, SampleFile.FAILED)
+
     def state(self, gi, library_id):
-        return gi.libraries.show_dataset(library_id, self.library_dataset_id)['state']
+        dataset = gi.libraries.show_dataset(library_id, self.library_dataset_id)
+        self.ldda_id = dataset.get('ldda_id', self.ldda_id)
+        return dataset['state']
 
     def delete(self, gi, library_id):
         return gi.libraries.delete_library_dataset(library_id, self.library_dataset_id, purged=True)['deleted']
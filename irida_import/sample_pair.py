@@ -20,6 +20,8 @@ class SamplePair:
 
     """A representation of a sample pair obtained from IRIDA"""
 
+    __slots__ = ('forward', 'reverse', 'name')
+
     def __init__(self, name, forward, reverse):
         """
         Create a sample file instance.
@@ -1,18 +1,37 @@
 import ast
+import asyncio
+import hashlib
+import http.server
 import os
+import random
+import socketserver
 import sys
+import threading
+import time
 import json
 import logging
 import pprint
 import pytest
+import queue
+import requests
+import tracemalloc
 import unittest.mock as mock
 
+from concurrent.futures import ThreadPoolExecutor
+
+import bioblend
+
 from requests_oauthlib import OAuth2Session
 from unittest.mock import Mock
 from bioblend import galaxy
 from bioblend.galaxy.objects import (GalaxyInstance, Library, Folder, client)
 from bioblend.galaxy.objects.wrappers import LibraryContentInfo
 from ...irida_import import IridaImport
+from ...async_irida_import import AsyncIridaImport
+from ...connection_pool import SessionRequests, mount_pool, pool_stats
+from ...disk_cache import DiskLRU, DownloadCache, ResponseCache
+from ...import_journal import ImportJournal
+from ...json_stream import JsonStream
 from ...sample import Sample
 from ...sample_file import SampleFile
 from ...sample_pair import SamplePair
@@ -24,12 +43,139 @@ class MockConfig:
         self.ILLUMINA_PATH = '/illumina_reads'
         self.REFERENCE_PATH = '/references'
         self.MAX_WAITS = 1
+        self.WAIT_SECONDS_PER_GB = 60
         self.MAX_RETRIES = 3
+        self.RETRY_DELAY = 5
         self.MAX_CLIENT_ATTEMPTS = 10
         self.CLIENT_RETRY_DELAY = 30
         self.CLIENT_ID = 'webClient'
         self.CLIENT_SECRET = 'webClientSecret'
         self.TOKEN_ENDPOINT = 'http://127.0.0.1:8080/api/oauth/token'
+        self.MAX_IRIDA_WORKERS = 4
+        self.MAX_TRANSFER_WORKERS = 4
+        self.LINK_BATCH_SIZE = 2
+        self.COLLECTIONS_FROM_LIBRARY = False
+        self.RESPONSE_CACHE_DIR = ''
+        self.RESPONSE_CACHE_MAX_MB = 256
+        self.DOWNLOAD_CACHE_DIR = ''
+        self.DOWNLOAD_CACHE_MAX_GB = 50
+        self.MAX_DOWNLOAD_RESUMES = 10
+        self.DOWNLOAD_SEGMENTS = 1
+        self.SEGMENTED_DOWNLOAD_MIN_BYTES = 1024 ** 3
+        self.PATH_MAPPINGS = []
+        self.TRANSFER_MODE = 'upload'
+
+
+def journal_files(sample):
+    """Get every SampleFile of a sample, including those in pairs"""
+    for sample_item in sample.get_reads():
+        if isinstance(sample_item, SamplePair):
+            yield sample_item.forward
+            yield sample_item.reverse
+        else:
+            yield sample_item
+
+
+class FakeRaw:
+    """A streamed response body that produces bytes without holding them"""
+
+    def __init__(self, size, content=b''):
+        self.remaining = size
+        self.content = content
+        self.decode_content = False
+
+    def readinto(self, buffer):
+        num_read = min(len(buffer), self.remaining)
+        if self.content:
+            buffer[:num_read] = self.content[-self.remaining:][:num_read]
+        self.remaining -= num_read
+        return num_read
+
+
+class DictSampleFile(SampleFile):
+    """
+    A SampleFile backed by a __dict__, as they were before slots, whose
+    methods can be mocked
+    """
+
+
+class CountingFile:
+    """A file-like sink that only counts what is written to it"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """An HTTP server handling each request on its own thread"""
+
+    daemon_threads = True
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    """Answers every GET with a small body over a kept-alive connection"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class DroppingRangeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the server's content, honouring Range requests, but drops the
+    connection part way through for each of the server's drops
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        content = self.server.content
+        start = 0
+        end = len(content) - 1
+        content_range = self.headers.get('Range')
+        if self.server.ignore_ranges:
+            content_range = None
+        with self.server.lock:
+            self.server.ranges.append(content_range)
+            drop = self.server.drops.pop(0) if self.server.drops else None
+        if content_range:
+            first, last = content_range[len('bytes='):].split('-')
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        body = content[start:end + 1]
+        self.send_response(206 if content_range else 200)
+        self.send_header('Content-Length', str(len(body)))
+        if content_range:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(content)))
+        self.end_headers()
+
+        if drop is not None:
+            self.wfile.write(body[:drop])
+            self.wfile.flush()
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
 
 
 class TestIridaImport:
@@ -80,6 +226,15 @@ class TestIridaImport:
         imp.logger = logging.getLogger('irida_import')
         return imp
 
+    @pytest.fixture(scope="function")
+    def async_imp(self, imp):
+        """Create an AsyncIridaImport instance, with a running event loop"""
+        async_imp = AsyncIridaImport(imp.config)
+        async_imp.__dict__.update(imp.__dict__)
+        async_imp._start_loop()
+        yield async_imp
+        async_imp._stop_loop()
+
     @pytest.fixture(scope='class')
     def file_list(self):
         """Obtain a list of files as if read from Galaxy"""
@@ -139,6 +294,334 @@ class TestIridaImport:
             assert isinstance(sample, Sample), 'The list must contain samples'
         assert len(samples) == 1, 'Number of samples is incorrect'
 
+    def make_pair_resource(self, identifier, directions):
+        """Make a pair resource as returned by IRIDA"""
+        pair_href = 'http://127.0.0.1/api/samples/1/pairs/{0}'.format(identifier)
+        files = []
+        links = [{'rel': 'self', 'href': pair_href}]
+        for i, direction in enumerate(directions):
+            href = '{0}/files/{1}'.format(pair_href, i)
+            files.append({
+                'fileName': '{0}_{1}.fastq'.format(identifier, direction),
+                'file': '/data/{0}_{1}.fastq'.format(identifier, direction),
+                'links': [{'rel': 'sample', 'href': 'http://127.0.0.1/api/samples/1'},
+                          {'rel': 'self', 'href': href}]})
+            links.append({'rel': 'pair/' + direction, 'href': href})
+        # IRIDA does not list the files in forward, reverse order
+        files.reverse()
+        return {'identifier': identifier, 'files': files, 'links': links}
+
+    def test_add_sample_files_matches_pairs(self, imp):
+        """Test that each pair's forward and reverse files are found"""
+        sample = Sample('bob', 'pairs', 'unpaired', '', '')
+        resources = {
+            'pairs': {'resources': [
+                self.make_pair_resource(1, ['forward', 'reverse']),
+                self.make_pair_resource(2, ['reverse', 'forward'])]},
+            'unpaired': {'resources': []},
+        }
+        imp.make_irida_request = Mock(side_effect=lambda url: resources[url])
+
+        imp._add_sample_files(sample, False, False)
+
+        pairs = sample.get_reads()
+        assert [pair.name for pair in pairs] == ['1', '2']
+        for pair in pairs:
+            assert pair.forward.name == pair.name + '_forward.fastq'
+            assert pair.reverse.name == pair.name + '_reverse.fastq'
+
+    def test_add_sample_files_pair_missing_direction(self, imp):
+        """Test that a pair without a reverse file is an error"""
+        sample = Sample('bob', 'pairs', 'unpaired', '', '')
+        resources = {
+            'pairs': {'resources': [
+                self.make_pair_resource(1, ['forward', 'reverse']),
+                self.make_pair_resource(2, ['forward'])]},
+            'unpaired': {'resources': []},
+        }
+        imp.make_irida_request = Mock(side_effect=lambda url: resources[url])
+
+        with pytest.raises(ValueError) as excinfo:
+            imp._add_sample_files(sample, False, False)
+        assert "Pair '2' of sample 'bob' has no reverse file" in str(excinfo.value)
+
+    def make_sample_input(self, name):
+        """Make a sample entry as found in the Galaxy json parameters"""
+        href = 'http://127.0.0.1/api/samples/' + name
+        return {
+            'name': name,
+            '_embedded': {'sample_files': [{'_links': {'self': {'href': href}}}]}
+        }
+
+    def write_param_file(self, path, samples):
+        """Write a Galaxy parameter file for the given samples"""
+        json_params = {'_embedded': {
+            'library': {'name': 'Project \u00e9 "5"'},
+            'user': {'email': 'jules@example.com'},
+            'addtohistory': True,
+            'oauth2': {'code': '4DEPzF', 'redirect': '/galaxy/auth_code'},
+            'samples': samples,
+            'makepairedcollection': False,
+        }}
+        with open(path, 'w') as param_fh:
+            json.dump({'param_dict': {'userId': '1',
+                                      'json_params': json.dumps(json_params)},
+                       'job_config': {'GALAXY_ROOT_DIR': '/galaxy'}}, param_fh)
+        return json_params
+
+    def test_json_params_stream_any_chunk_size(self, imp, tmpdir):
+        """Test that the streamed parameters match the parsed parameters"""
+        samples = [self.make_sample_input(name) for name in
+                   ['01-1111', 'back\\slash', 'quote"d', 'smile \U0001F600', '\u00e9\n']]
+        path = str(tmpdir.join('params.dat'))
+        json_params = self.write_param_file(path, samples)
+
+        for chunk_size in [1, 2, 3, 5, 7, 11, 13, 64 * 1024]:
+            imp.PARAM_CHUNK_SIZE = chunk_size
+            with open(path) as param_fh:
+                loaded = imp._json_params(param_fh).load(skip=imp.SAMPLES_PATH)
+            assert loaded['_embedded']['samples'] == []
+            loaded['_embedded']['samples'] = samples
+            assert loaded == json_params
+            assert list(imp._iter_param_samples(path)) == samples
+
+    def test_json_stream_numbers_any_chunk_size(self):
+        """Test that numbers split between chunks are decoded whole"""
+        document = {'n': 12.5, 'e': -1.25e+10, 'E': 3E-2, 'i': 12, 'z': -0.0,
+                    'values': [12.5, 7e3, 1, -4.5e-1], 'last': 2.75}
+        text = json.dumps(document).replace('7000.0', '7e3')
+        for chunk_size in range(1, len(text) + 1):
+            chunks = [text[i:i + chunk_size]
+                      for i in range(0, len(text), chunk_size)]
+            assert JsonStream(chunks).load() == document
+            assert list(JsonStream(chunks).iter_items(['values'])) == \
+                document['values']
+
+    def test_json_params_stream_memory_is_flat(self, imp, tmpdir):
+        """Test that reading the parameters does not hold every sample"""
+        def peak_memory(num_samples):
+            path = str(tmpdir.join('params{0}.dat'.format(num_samples)))
+            self.write_param_file(
+                path, [self.make_sample_input(str(i)) for i in range(num_samples)])
+            tracemalloc.start()
+            with open(path) as param_fh:
+                imp._json_params(param_fh).load(skip=imp.SAMPLES_PATH)
+            count = sum(1 for _ in imp._iter_param_samples(path))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert count == num_samples
+            return peak
+
+        small = peak_memory(1000)
+        large = peak_memory(20000)
+        assert large < 2 * small, \
+            'Peak memory must not grow with the number of samples'
+
+    def test_get_sample_meta_keeps_order(self, imp):
+        """Test that samples resolved concurrently keep their original order"""
+        names = [str(i) for i in range(50)]
+        samples_dict = [self.make_sample_input(name) for name in names]
+
+        def make_irida_request(url):
+            return {'links': [{'rel': 'sample/sequenceFiles/pairs',
+                               'href': url + '/pairs'}]}
+        imp.make_irida_request = Mock(side_effect=make_irida_request)
+
+        samples = imp.get_sample_meta(samples_dict)
+
+        assert [sample.name for sample in samples] == names, \
+            'Samples must be returned in their original order'
+        assert samples[7].paired_path == 'http://127.0.0.1/api/samples/7/pairs'
+        assert imp.make_irida_request.call_count == len(names)
+
+    def test_get_sample_meta_error_names_sample(self, imp):
+        """Test that a failure is attributed to its sample and others finish"""
+        samples_dict = [self.make_sample_input(name) for name in ['a', 'b', 'c', 'd']]
+        failing = ['b']
+
+        def make_irida_request(url):
+            if url.rsplit('/', 1)[1] in failing:
+                raise IOError('IRIDA is unavailable')
+            return {'links': []}
+        imp.make_irida_request = Mock(side_effect=make_irida_request)
+
+        with pytest.raises(IOError):
+            imp.get_sample_meta(samples_dict)
+        assert imp.make_irida_request.call_count == 4, \
+            'The other samples must still be resolved'
+
+        failing.append('d')
+        with pytest.raises(ValueError) as error:
+            imp.get_sample_meta(samples_dict)
+        assert "sample 'b'" in str(error.value), 'Failed samples must be named'
+        assert "sample 'd'" in str(error.value), 'Failed samples must be named'
+        assert "sample 'a'" not in str(error.value)
+
+    def test_make_irida_request_revalidates_cached_response(self, imp, tmpdir):
+        """Test that cached IRIDA responses are revalidated, per user"""
+        url = 'http://127.0.0.1:8080/api/samples/1'
+        imp.pp = pprint.PrettyPrinter(indent=4)
+        imp.response_cache = ResponseCache(str(tmpdir), 1024 * 1024)
+        imp.irida_user = 'jules@example.com'
+        imp.irida.get.return_value = Mock(
+            status_code=200, headers={'ETag': '"v1"'},
+            json=Mock(return_value={'resource': {'name': 'bob'}}))
+        assert imp.make_irida_request(url) == {'name': 'bob'}
+        assert imp.irida.get.call_args[1]['headers'] == {}
+
+        # A later import revalidates the cached response
+        imp._irida_requests.clear()
+        imp.irida.get.return_value = Mock(status_code=304, headers={})
+        assert imp.make_irida_request(url) == {'name': 'bob'}
+        assert imp.irida.get.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+        assert not imp.irida.get.return_value.raise_for_status.called
+
+        # Responses made for one user are never used for another
+        imp.irida_user = 'someone@example.com'
+        imp._irida_requests.clear()
+        imp.irida.get.return_value = Mock(
+            status_code=200, headers={},
+            json=Mock(return_value={'resource': {'name': 'other'}}))
+        assert imp.make_irida_request(url) == {'name': 'other'}
+        assert imp.irida.get.call_args[1]['headers'] == {}
+
+    def test_make_irida_request_single_flight(self, imp):
+        """Test that concurrent requests for one URL share one request"""
+        url = 'http://127.0.0.1:8080/api/samples/1'
+        imp.pp = pprint.PrettyPrinter(indent=4)
+
+        def get(request_url, headers):
+            time.sleep(0.05)
+            return Mock(status_code=200, headers={},
+                        json=Mock(return_value={'resource': {'name': 'bob'}}))
+
+        imp.irida.get.side_effect = get
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            resources = list(executor.map(
+                lambda i: imp.make_irida_request(url), range(8)))
+
+        assert imp.irida.get.call_count == 1
+        assert all(resource == {'name': 'bob'} for resource in resources)
+        assert imp.make_irida_request(url) == {'name': 'bob'}
+        assert imp.irida.get.call_count == 1, 'Repeated URLs are not refetched'
+
+    def test_make_irida_request_memo_size(self, imp):
+        """Test that only the most recently used resources are kept"""
+        imp.pp = pprint.PrettyPrinter(indent=4)
+        imp.IRIDA_REQUESTS_MEMO_SIZE = 2
+        imp.irida.get.return_value = Mock(
+            status_code=200, headers={},
+            json=Mock(return_value={'resource': {'name': 'bob'}}))
+        urls = ['http://127.0.0.1:8080/api/samples/{0}'.format(i)
+                for i in range(3)]
+
+        imp.make_irida_request(urls[0])
+        imp.make_irida_request(urls[1])
+        imp.make_irida_request(urls[0])
+        imp.make_irida_request(urls[2])
+        assert list(imp._irida_requests) == [urls[0], urls[2]]
+
+        imp.make_irida_request(urls[0])
+        assert imp.irida.get.call_count == 3
+        imp.make_irida_request(urls[1])
+        assert imp.irida.get.call_count == 4, 'Dropped resources are refetched'
+
+    def test_make_irida_request_retries_failed_request(self, imp):
+        """Test that a failed request is not kept"""
+        url = 'http://127.0.0.1:8080/api/samples/1'
+        imp.pp = pprint.PrettyPrinter(indent=4)
+        imp.irida.get.side_effect = [
+            ConnectionError('down'),
+            Mock(status_code=200, headers={},
+                 json=Mock(return_value={'resource': {'name': 'bob'}}))]
+
+        with pytest.raises(ConnectionError):
+            imp.make_irida_request(url)
+        assert imp.make_irida_request(url) == {'name': 'bob'}
+        assert imp.irida.get.call_count == 2
+
+    def test_disk_lru_evicts_least_recently_used(self, tmpdir):
+        """Test that the disk cache stays under capacity across runs"""
+        lru = DiskLRU(str(tmpdir.join('cache')), 25)
+        for key in ['a', 'b', 'c']:
+            with lru.temp_file() as entry_fh:
+                entry_fh.write(key * 10)
+            assert lru.put(key, entry_fh.name)
+            time.sleep(0.01)
+            if key == 'b':
+                assert lru.get('a') is not None
+
+        assert lru.get('b') is None, 'The least recently used file is evicted'
+        assert lru.size == 20
+
+        reopened = DiskLRU(str(tmpdir.join('cache')), 25)
+        assert reopened.size == 20
+        assert list(reopened._sizes) == ['a', 'c']
+        with reopened.temp_file() as entry_fh:
+            entry_fh.write('x' * 30)
+        assert not reopened.put('x', entry_fh.name), \
+            'Files larger than the cache are not kept'
+        assert sorted(os.listdir(str(tmpdir.join('cache')))) == \
+            [DiskLRU.LOCK_DIR, 'a', 'c']
+
+    def test_disk_lru_counts_temporary_files(self, tmpdir):
+        """Test that temporary files count, and are only evicted once unused"""
+        directory = str(tmpdir.join('cache'))
+        lru = DiskLRU(directory, 30)
+        day = 24 * 60 * 60
+        # Another process downloading into one partial file and uploading
+        # from a temporary directory
+        with lru.locked('.partial-held'), lru.temp_dir() as held_dir:
+            for path in [lru.path('.partial-held'), lru.path('.partial-old'),
+                         os.path.join(held_dir, 'reads.fastq'), lru.path('.fresh')]:
+                with open(path, 'w') as tmp_fh:
+                    tmp_fh.write('t' * 5)
+            for days, path in [(4, lru.path('.partial-held')),
+                               (3, lru.path('.partial-old')), (2, held_dir)]:
+                os.utime(path, (time.time() - days * day,) * 2)
+
+            reopened = DiskLRU(directory, 30)
+            assert reopened.size == 20, 'Files left behind must be counted'
+            with reopened.temp_file() as entry_fh:
+                entry_fh.write('a' * 20)
+            assert reopened.put('a', entry_fh.name)
+            assert reopened.size == 35
+            assert sorted(os.listdir(directory)) == sorted(
+                ['.fresh', DiskLRU.LOCK_DIR, '.partial-held',
+                 os.path.basename(held_dir), 'a']), \
+                'Only the unused, old temporary file may be evicted'
+
+        # Interrupted downloads are counted once they are let go of
+        reopened.TEMP_GRACE_SECONDS = 0
+        with open(reopened.path('.partial-new'), 'w') as partial_fh:
+            partial_fh.write('n' * 5)
+        reopened.track('.partial-new')
+        assert reopened.size == 30
+        assert sorted(os.listdir(directory)) == \
+            ['.fresh', DiskLRU.LOCK_DIR, '.partial-new', 'a']
+
+    def test_sample_file_memory(self):
+        """Test that slotted sample files take less memory per file"""
+        def bytes_per_file(cls, num_files=20000):
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            sample_files = [
+                cls(name='r%d.fast5' % i, path='/data/r%d.fast5' % i,
+                    href='http://127.0.0.1/api/samples/1/fast5/%d' % i,
+                    file_size=i, upload_sha_256='%064x' % i)
+                for i in range(num_files)]
+            used = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            assert len(sample_files) == num_files
+            return used / num_files
+
+        before = bytes_per_file(DictSampleFile)
+        after = bytes_per_file(SampleFile)
+        logging.info("Bytes per sample file: {0:.0f} with a __dict__, "
+                     "{1:.0f} with slots".format(before, after))
+        assert not hasattr(SampleFile('a', '/a', 'http://a'), '__dict__')
+        assert after < before, 'Slots must save the per-object dict'
+
     def test_get_fastq_file(self, imp):
         """
         Test if correct sample_file object is created and the content type
@@ -307,23 +790,78 @@ class TestIridaImport:
         imp.gi.libraries.get = Mock(return_value=imp.library)
 
 
-        items = {}
-        items['sally.fastq']={}
-        items['sally.fastq']['id']=123
-        items['sally.fastq']['type']='file'
-        items['sally.fastq']['name']='sally.fastq'
-
-        items['bob.fasta']={}
-        items['bob.fasta']['id']=234
-        items['bob.fasta']['type']='file'
-        items['bob.fasta']['name']='bob.fasta'
-
-        imp.folds = items
+        imp._index_lib_item('file', 'sally.fastq', 123)
+        imp._index_lib_item('file', 'bob.fasta', 234)
+        imp._index_lib_item('folder', 'bob.fasta', 345)
 
         exists = imp.exists_in_lib('file', 'name', 'bob.fasta')
         assert exists, 'file must exist in library'
-
-    def test_add_samples_if_nec(self, imp, file_list):
+        assert exists == [234], 'only the file with that type must be found'
+
+    def test_exists_in_lib_large_library(self, imp):
+        """ Benchmark lookups against a synthetic 200k item library """
+        num_items = 200000
+        library_info = [{'id': '0', 'type': 'folder', 'name': '/illumina_reads'}]
+        for i in range(1, num_items):
+            library_info.append({
+                'id': str(i),
+                'type': 'file',
+                'name': '/illumina_reads/sample%d/file%d.fastq' % (i // 10, i)
+            })
+        imp.reg_gi.libraries.show_library = Mock(return_value=library_info)
+
+        start = time.time()
+        imp.initial_lib_state()
+        index_time = time.time() - start
+
+        start = time.time()
+        for i in range(1, num_items):
+            found = imp.exists_in_lib(
+                'file', 'name', '/illumina_reads/sample%d/file%d.fastq' % (i // 10, i))
+            assert found == [str(i)]
+        lookup_time = time.time() - start
+
+        logging.info("Indexed %d library items in %.3fs and looked each up in %.3fs",
+                     num_items, index_time, lookup_time)
+        assert imp.reg_gi.libraries.show_library.call_count == 1, \
+            'The library must only be listed once'
+        assert not imp.exists_in_lib('folder', 'name', '/illumina_reads/sample0/file1.fastq')
+        # A linear scan takes minutes for this many lookups
+        assert lookup_time < 10, 'Library lookups must not scan the library'
+
+    def test_create_folder_if_nec_indexes_folder(self, imp):
+        """ Test that created folders are found without listing the library """
+        imp.reg_gi.libraries.show_library = Mock(return_value=[
+            {'type': 'folder', 'name': '/illumina_reads', 'id': '1'}])
+        imp.reg_gi.libraries.create_folder = Mock(
+            return_value=[{'id': '2', 'name': 'sample1'}])
+
+        assert imp.create_folder_if_nec('/illumina_reads/sample1') == '2'
+        assert imp.create_folder_if_nec('/illumina_reads/sample1') == '2'
+        assert imp.reg_gi.libraries.create_folder.call_count == 1, \
+            'An indexed folder must not be created again'
+        assert imp.reg_gi.libraries.show_library.call_count == 1, \
+            'The library must only be listed once'
+
+    def test_initial_lib_state_once_across_threads(self, imp):
+        """Test that workers needing the library at once list it once"""
+        def show_library(library_id, contents):
+            time.sleep(0.05)
+            return [{'type': 'file', 'name': '/illumina_reads/s%d.fastq' % i,
+                     'id': str(i)} for i in range(100)]
+        imp.reg_gi.libraries.show_library = Mock(side_effect=show_library)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            found = list(executor.map(
+                lambda i: imp.exists_in_lib(
+                    'file', 'name', '/illumina_reads/s%d.fastq' % i),
+                range(99, 91, -1)))
+
+        assert found == [[str(i)] for i in range(99, 91, -1)], \
+            'No worker may see a partly indexed library'
+        assert imp.reg_gi.libraries.show_library.call_count == 1
+
+    def test_add_samples_if_nec(self, imp, file_list, monkeypatch):
         """ Test if a new sample file is added to the library """
 
         imp.exists_in_lib = Mock()
@@ -334,7 +872,7 @@ class TestIridaImport:
         imp._add_file.return_value = [{'id': '321'}]
         side_effect_list = [[file_dict] for file_dict in file_list]
         imp.link.side_effect = side_effect_list
-        os.path.isfile = Mock(return_value=True)
+        monkeypatch.setattr(os.path, "isfile", Mock(return_value=True))
         imp.unique_file = Mock(return_value=True)
 
         sampleFile1 = SampleFile(name='file1', path="/imaginary/path/file1.fasta", href="http://127.0.0.1/api/samples/1/pairs/1/files/1")
@@ -365,7 +903,196 @@ class TestIridaImport:
 
         assert num_added == 4, "The correct amount of files need to be uploaded"
 
-    def test_add_samples_to_history(self, imp, file_list):
+    def test_add_samples_if_nec_concurrent_accounting(self, imp):
+        """Test that concurrent transfers log every file exactly once"""
+        sample = Sample("bobname",
+                        "/imaginary/path/Samples/1/paired",
+                        "/imaginary/path/Samples/1/unpaired",
+                        "/imaginary/path/Samples/1/assemblies",
+                        "/imaginary/path/Samples/1/fast5")
+        for i in range(40):
+            sample.add_file(SampleFile(
+                name='file%d.fastq' % i, path='/not/local/file%d.fastq' % i,
+                href="http://127.0.0.1/api/samples/1/sequenceFiles/%d" % i,
+                file_size=10))
+
+        imp.create_folder_if_nec = Mock(return_value='321')
+        # Every third file is already in the library
+        imp.existing_file = Mock(side_effect=lambda sample_file_path, galaxy_name, size, sample_file:
+                                 'existing' if int(sample_file_path[15:-6]) % 3 == 0 else False)
+        imp.upload_file_to_galaxy = Mock(side_effect=lambda sample_file, folder_id:
+                                         [{'id': 'new-' + sample_file.name}])
+
+        with mock.patch('os.path.isfile', Mock(return_value=False)):
+            num_added = imp.add_samples_if_nec([sample])
+
+        assert num_added == 40
+        assert len(imp.skipped_files_log) == 14
+        assert len(imp.uploaded_files_log) == 26
+        assert imp.upload_file_to_galaxy.call_count == 26
+        for sample_file in sample.get_reads():
+            assert sample_file.library_dataset_id is not None, \
+                'Every file must have a library dataset'
+
+    def make_polled_file(self, name, states, file_size=None):
+        """Make a sample file whose Galaxy state goes through states"""
+        sample_file = DictSampleFile(
+            name=name, path='/not/local/' + name,
+            href="http://127.0.0.1/api/samples/1/sequenceFiles/1",
+            file_size=file_size)
+        sample_file.library_dataset_id = name
+        sample_file.state = Mock(side_effect=states)
+        return sample_file
+
+    def test_samples_uploaded_successfully_polls_together(self, imp):
+        """Test that pending datasets are polled in rounds with backoff"""
+        quick = self.make_polled_file('quick', ['ok'])
+        slow = self.make_polled_file('slow', ['queued', 'running', 'running', 'ok'])
+        slower = self.make_polled_file('slower', ['new'] * 4 + ['ok'])
+        sample = Sample("bobname", "", "", "", "")
+        sample.add_file(quick)
+        sample.add_pair(SamplePair('pair1', slow, slower))
+
+        with mock.patch('time.sleep') as sleep:
+            assert imp.samples_uploaded_successfully([sample])
+
+        assert quick.state.call_count == 1, 'Verified datasets must not be polled again'
+        assert slow.state.call_count == 4
+        assert slower.state.call_count == 5
+        assert [call[0][0] for call in sleep.call_args_list] == [1, 2, 4, 8], \
+            'All datasets must share one wait per round, backing off exponentially'
+
+    def test_verify_samples_integrity_wait_scales_with_size(self, imp):
+        """Test that large files are given more time to finish uploading"""
+        small = self.make_polled_file('small', ['running'] * 100)
+        large = self.make_polled_file('large', ['running'] * 5 + ['ok'],
+                                      file_size=2 * 1024 ** 3)
+        clock = [0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        with mock.patch('time.sleep', side_effect=sleep), \
+                mock.patch('time.time', side_effect=lambda: clock[0]):
+            assert imp.verify_samples_integrity([small, large]) == [False, True]
+
+        # The small file times out at the poll 7 seconds in, while the
+        # large file is still waited for until it is ok 31 seconds in
+        assert small.state.call_count == 4
+        assert large.state.call_count == 6
+
+    def test_add_samples_if_nec_only_retries_failed_files(self, imp):
+        """Test that a retry round only transfers the files that failed"""
+        done = SampleFile(name='done.fastq', path='/not/local/done.fastq',
+                          href="http://127.0.0.1/api/samples/1/sequenceFiles/1")
+        failed = SampleFile(name='failed.fastq', path='/not/local/failed.fastq',
+                            href="http://127.0.0.1/api/samples/2/sequenceFiles/2")
+        done.verified = True
+        failed.status = SampleFile.FAILED
+        done_sample = Sample("done", "", "", "", "")
+        done_sample.add_file(done)
+        failed_sample = Sample("failed", "", "", "", "")
+        failed_sample.add_file(failed)
+
+        imp.create_folder_if_nec = Mock(return_value='321')
+        imp.existing_file = Mock(return_value=False)
+        imp.upload_file_to_galaxy = Mock(return_value=[{'id': '456'}])
+
+        with mock.patch('os.path.isfile', Mock(return_value=False)):
+            assert imp.add_samples_if_nec([done_sample, failed_sample]) == 1
+
+        imp.create_folder_if_nec.assert_called_once_with('/illumina_reads/failed')
+        imp.upload_file_to_galaxy.assert_called_once_with(failed, '321')
+        assert failed.status == SampleFile.VERIFYING
+        assert failed.library_dataset_id == '456'
+        assert done.status == SampleFile.OK
+
+    def test_add_file_failure_is_retried(self, imp):
+        """Test that a file is not left transferring when its transfer raises"""
+        sample_file = SampleFile(name='file1.fastq', path='/not/local/file1.fastq',
+                                 href="http://127.0.0.1/api/samples/1/sequenceFiles/1")
+        imp.existing_file = Mock(side_effect=ConnectionError('Galaxy is down'))
+
+        with mock.patch('os.path.isfile', Mock(return_value=False)):
+            with pytest.raises(ConnectionError):
+                imp._add_file([], '/illumina_reads/s', '321', sample_file)
+
+        assert sample_file.status == SampleFile.FAILED
+        assert sample_file.needs_transfer(), 'The next retry must transfer it'
+
+    def test_verify_samples_integrity_undeletable_dataset(self, imp):
+        """Test that a failed dataset that cannot be deleted does not hang"""
+        sample_file = self.make_polled_file('bad', ['error'])
+        sample_file.delete = Mock(side_effect=[
+            False, requests.ConnectionError('refused'), False, False])
+
+        with mock.patch('time.sleep') as sleep:
+            assert imp.verify_samples_integrity([sample_file]) == [False]
+        assert sample_file.delete.call_count == imp.config.MAX_RETRIES + 1
+        assert [call[0][0] for call in sleep.call_args_list] == [1, 2, 4], \
+            'Attempts to delete must back off'
+        assert sample_file.status == SampleFile.FAILED
+        assert sample_file.library_dataset_id is None, \
+            'A file whose dataset could not be deleted must be transferred again'
+        assert sample_file.needs_transfer()
+
+    def test_async_map_in_pool_limits_each_host(self, async_imp):
+        """Test that the asyncio engine keeps order and limits concurrency"""
+        lock = threading.Lock()
+        running = [0]
+        most_running = [0]
+
+        def work(item):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            time.sleep(0.001)
+            with lock:
+                running[0] -= 1
+            return item * 2
+
+        results = async_imp._map_in_pool(work, range(100), 8, str, host='irida')
+
+        assert results == [item * 2 for item in range(100)]
+        assert most_running[0] <= async_imp.config.MAX_IRIDA_WORKERS
+
+    def test_async_map_in_pool_error_names_item(self, async_imp):
+        """Test that the asyncio engine reports errors like the thread engine"""
+        def work(item):
+            if item == 3:
+                raise KeyError(item)
+            return item
+
+        with pytest.raises(KeyError):
+            async_imp._map_in_pool(work, range(5), 4, str)
+
+    def test_async_add_samples_if_nec_concurrent_accounting(self, async_imp):
+        """Test that the asyncio engine transfers like the thread engine"""
+        self.test_add_samples_if_nec_concurrent_accounting(async_imp)
+
+    def test_async_verify_samples_integrity(self, async_imp):
+        """Test that each dataset is polled with its own backoff"""
+        quick = self.make_polled_file('quick', ['ok'])
+        slow = self.make_polled_file('slow', ['queued', 'running', 'ok'])
+        bad = self.make_polled_file('bad', ['error'])
+        bad.delete = Mock(return_value=False)
+        async_imp.DELETE_RETRY_DELAY = 0
+        delays = []
+        real_sleep = asyncio.sleep
+
+        async def sleep(delay):
+            delays.append(delay)
+            await real_sleep(0)
+
+        with mock.patch('asyncio.sleep', sleep):
+            assert async_imp.verify_samples_integrity([quick, slow, bad]) == \
+                [True, True, False]
+
+        assert slow.state.call_count == 3
+        assert delays == [1, 2], 'Only the pending dataset waits between polls'
+        assert bad.status == SampleFile.FAILED
+
+    def test_add_samples_to_history(self, imp, file_list, monkeypatch):
         """ Test if a new sample file is added to the library """
         imp.exists_in_lib = Mock(return_value=False)
         imp.link = mock.create_autospec(IridaImport.link)
@@ -373,8 +1100,8 @@ class TestIridaImport:
         imp._add_file.return_value = [{'id': '321'}]
         side_effect_list = [[file_dict] for file_dict in file_list]
         imp.link.side_effect = side_effect_list
-        os.path.isfile = Mock(return_value=True)
-        os.path.getsize = Mock(return_value=5678)
+        monkeypatch.setattr(os.path, "isfile", Mock(return_value=True))
+        monkeypatch.setattr(os.path, "getsize", Mock(return_value=5678))
         imp.unique_file = Mock(return_value=True)
 
         history = imp.reg_gi.histories.create_history()
@@ -413,6 +1140,110 @@ class TestIridaImport:
 
         assert not collection_array, 'List should be empty, collections was set to false'
 
+    def make_history_samples(self, num_pairs):
+        """Make a sample with num_pairs pairs and one single file, in a library"""
+        sample = Sample("bobname", "", "", "", "")
+        for i in range(num_pairs):
+            forward = SampleFile(name='f%d' % i, path='/f%d' % i,
+                                 href="http://127.0.0.1/api/samples/1/pairs/%d/files/1" % i)
+            reverse = SampleFile(name='r%d' % i, path='/r%d' % i,
+                                 href="http://127.0.0.1/api/samples/1/pairs/%d/files/2" % i)
+            forward.library_dataset_id = 'ld-f%d' % i
+            reverse.library_dataset_id = 'ld-r%d' % i
+            sample.add_pair(SamplePair('pair%d' % i, forward, reverse))
+        single = SampleFile(name='s', path='/s',
+                            href="http://127.0.0.1/api/samples/1/sequenceFiles/1")
+        single.library_dataset_id = 'ld-s'
+        sample.add_file(single)
+        return sample
+
+    def test_add_samples_to_history_hides_in_batch(self, imp):
+        """Test that paired datasets are hidden with one batch request"""
+        imp.histories.upload_dataset_from_library = Mock(
+            side_effect=lambda hist_id, lib_dataset_id: {'id': 'h' + lib_dataset_id})
+        imp.histories._make_url = Mock(return_value='/api/histories/hist1/contents')
+
+        collection_array = imp.add_samples_to_history(
+            [self.make_history_samples(10)], 'hist1')
+
+        assert imp.histories.upload_dataset_from_library.call_count == 21
+        assert imp.histories.update_dataset.call_count == 0, \
+            'Datasets must not be hidden one at a time'
+        imp.histories._put.assert_called_once_with(
+            mock.ANY, url='/api/histories/hist1/contents')
+        payload = imp.histories._put.call_args[0][0]
+        assert payload['visible'] is False
+        assert len(payload['items']) == 20
+        assert {'id': 'hld-s', 'history_content_type': 'dataset'} not in payload['items'], \
+            'Single files must stay visible'
+        assert len(collection_array) == 10
+        assert collection_array[3]['name'] == 'bobname__4'
+        assert collection_array[3]['element_identifiers'] == [
+            {'src': 'hda', 'name': 'forward', 'id': 'hld-f3'},
+            {'src': 'hda', 'name': 'reverse', 'id': 'hld-r3'}]
+
+    def test_add_samples_to_history_hide_fallback(self, imp):
+        """Test that datasets are hidden one at a time without batch updates"""
+        imp.histories.upload_dataset_from_library = Mock(
+            side_effect=lambda hist_id, lib_dataset_id: {'id': 'h' + lib_dataset_id})
+        imp.histories._put = Mock(side_effect=bioblend.ConnectionError(
+            'Unexpected HTTP status code: 404', status_code=404))
+
+        imp.add_samples_to_history([self.make_history_samples(2)], 'hist1')
+
+        assert imp.histories.update_dataset.call_count == 4
+        imp.histories.update_dataset.assert_any_call('hist1', 'hld-r1', visible=False)
+
+    def test_add_samples_to_history_collections_from_library(self, imp):
+        """Test that collections can point straight at library datasets"""
+        imp.config.COLLECTIONS_FROM_LIBRARY = True
+        imp.histories.upload_dataset_from_library = Mock(
+            side_effect=lambda hist_id, lib_dataset_id: {'id': 'h' + lib_dataset_id})
+        sample = self.make_history_samples(10)
+        # Verifying a dataset records its ldda id
+        forward = sample.get_reads()[0].forward
+        imp.reg_gi.libraries.show_dataset = Mock(
+            side_effect=lambda library_id, dataset_id: {
+                'state': 'ok', 'ldda_id': 'ldda-' + dataset_id})
+        assert forward.state(imp.reg_gi, imp.library.id) == 'ok'
+        assert forward.ldda_id == 'ldda-ld-f0'
+
+        collection_array = imp.add_samples_to_history([sample], 'hist1')
+
+        imp.histories.upload_dataset_from_library.assert_called_once_with('hist1', 'ld-s')
+        assert imp.histories._put.call_count == 0, 'Nothing must need hiding'
+        assert imp.reg_gi.libraries.show_dataset.call_count == 1 + 19, \
+            'Only unknown ldda ids must be looked up'
+        assert imp.histories.create_dataset_collection.call_count == 0
+        imp.histories._post.assert_called_once_with(mock.ANY, id='hist1', contents=True)
+        collection_desc = imp.histories._post.call_args[0][0]
+        assert collection_desc['collection_type'] == 'list:paired'
+        assert collection_desc['hide_source_items'] is True
+        assert collection_desc['element_identifiers'] == collection_array
+        assert collection_array[9]['element_identifiers'] == [
+            {'src': 'ldda', 'name': 'forward', 'id': 'ldda-ld-f9'},
+            {'src': 'ldda', 'name': 'reverse', 'id': 'ldda-ld-r9'}]
+
+    def test_existing_file_keeps_ldda_id(self, imp):
+        """Test that a file already in the library needs no ldda id lookup"""
+        imp.reg_gi.libraries.show_library = Mock(return_value=[
+            {'type': 'file', 'name': '/illumina_reads/s/file1.fastq', 'id': 'ld1'},
+            {'type': 'file', 'name': '/illumina_reads/s/file1.fastq', 'id': 'ld2'}])
+        imp.reg_gi.libraries.show_dataset = Mock(
+            side_effect=lambda library_id, dataset_id: {
+                'id': dataset_id, 'state': 'ok', 'ldda_id': 'ldda-' + dataset_id,
+                'file_size': 10 if dataset_id == 'ld2' else 5})
+        sample_file = SampleFile(name='file1.fastq', path='/not/local/file1.fastq',
+                                 href="http://127.0.0.1/api/samples/1/sequenceFiles/1",
+                                 file_size=10)
+
+        assert imp.existing_file(sample_file.path, '/illumina_reads/s/file1.fastq',
+                                 10, sample_file=sample_file) == 'ld2'
+        assert sample_file.ldda_id == 'ldda-ld2'
+        imp._set_ldda_ids([sample_file])
+        assert imp.reg_gi.libraries.show_dataset.call_count == 2, \
+            'The ldda id of an existing file must not be looked up again'
+
     def test_link(self, imp, folder_list):
         """Test uploading a local sample file to Galaxy as a link"""
         imp.library = mock.create_autospec(Library)
@@ -433,12 +1264,812 @@ class TestIridaImport:
         uploaded = imp.link(sample_file, sample_folder_path)
         assert uploaded == single_file_list, 'The correct file must be made'
 
+    def test_path_mappings_link_shared_files(self, imp, tmpdir):
+        """Test that files under a mapped path are linked, not uploaded"""
+        shared = tmpdir.mkdir('mnt').mkdir('Sequencing')
+        shared.join('file1.fastq').write('ACGT')
+        imp.config.PATH_MAPPINGS = [
+            ('/irida/data/Sequencing', str(shared)),
+            ('/irida/data', str(tmpdir.join('elsewhere'))),
+        ]
+        imp.library = mock.create_autospec(Library)
+        imp.library.id = 12345
+        imp.existing_file = Mock(return_value=False)
+        imp.upload_file_to_galaxy = Mock()
+        imp.reg_gi.libraries.upload_from_galaxy_filesystem = Mock(
+            return_value=[{'id': 'linked1', 'name': 'file1.fastq'}])
+        imp.uploaded_files_log = []
+
+        sample_file = SampleFile(
+            name='file1.fastq', path='/irida/data/Sequencing/file1.fastq',
+            href="http://127.0.0.1/api/samples/1/sequenceFiles/1")
+        imp._add_file(sample_folder_path='/bobsample',
+                      sample_folder_id='folder1', sample_file=sample_file)
+
+        assert sample_file.library_dataset_id == 'linked1'
+        assert imp.upload_file_to_galaxy.call_count == 0
+        linked_path = imp.reg_gi.libraries.upload_from_galaxy_filesystem.call_args[0][1]
+        assert linked_path == str(shared.join('file1.fastq'))
+
+        # Only whole path components match
+        assert imp.galaxy_path('/irida/data/Sequencing2/file1.fastq') == \
+            str(tmpdir.join('elsewhere', 'Sequencing2', 'file1.fastq'))
+        assert imp.galaxy_path('/other/file1.fastq') == '/other/file1.fastq'
+
+    def test_fetch_file_to_galaxy(self, imp):
+        """Test that Galaxy is asked to fetch non-local files from IRIDA"""
+        imp.config.TRANSFER_MODE = 'fetch'
+        imp.POLL_INITIAL_DELAY = 0
+        imp.library = mock.create_autospec(Library)
+        imp.library.id = 12345
+        imp.irida = Mock()
+        imp.irida.token = {'access_token': 'token1'}
+        imp.existing_file = Mock(return_value=False)
+        imp.upload_file_to_galaxy = Mock()
+        imp.uploaded_files_log = []
+        imp.reg_gi.url = 'http://127.0.0.1:8888/api'
+        imp.reg_gi.make_post_request = Mock(return_value={'jobs': [{'id': 'job1'}]})
+        imp.reg_gi.jobs = Mock()
+        imp.reg_gi.jobs.show_job = Mock(side_effect=[
+            {'state': 'queued'}, {'state': 'running'},
+            {'state': 'ok', 'outputs': {
+                'output0': {'id': 'ldda2', 'src': 'ldda'}}}])
+        # Another dataset of the same name, fetched at the same time
+        imp.reg_gi.make_get_request = Mock()
+        imp.reg_gi.make_get_request.return_value.json.return_value = {
+            'folder_contents': [
+                {'type': 'file', 'name': 'file1.fastq', 'id': 'fetched2',
+                 'ldda_id': 'ldda3'},
+                {'type': 'file', 'name': 'file1.fastq', 'id': 'fetched1',
+                 'ldda_id': 'ldda2'},
+                {'type': 'folder', 'name': 'file1.fastq', 'id': 'Ffolder1'},
+            ]}
+
+        sample_file = SampleFile(
+            name='file1.fastq', path='/not/local/file1.fastq',
+            href="http://127.0.0.1/api/samples/1/sequenceFiles/1",
+            upload_sha_256='abc')
+        imp._add_file(sample_folder_path='/bobsample',
+                      sample_folder_id='folder1', sample_file=sample_file)
+
+        assert sample_file.library_dataset_id == 'fetched1'
+        assert sample_file.ldda_id == 'ldda2'
+        assert imp.upload_file_to_galaxy.call_count == 0
+        assert imp.reg_gi.jobs.show_job.call_count == 3
+        url, = imp.reg_gi.make_post_request.call_args[0]
+        assert url == 'http://127.0.0.1:8888/api/tools/fetch'
+        target, = imp.reg_gi.make_post_request.call_args[1]['payload']['targets']
+        assert target['destination'] == {'type': 'library_folder',
+                                         'library_folder_id': 'folder1'}
+        item, = target['items']
+        assert item['src'] == 'url'
+        assert item['url'] == sample_file.href
+        assert item['headers']['Authorization'] == 'Bearer token1'
+        assert item['hashes'] == [{'hash_function': 'SHA-256',
+                                   'hash_value': 'abc'}]
+
+        # A job that failed is a failed transfer
+        imp.reg_gi.jobs.show_job = Mock(return_value={'state': 'error'})
+        sample_file.library_dataset_id = None
+        with pytest.raises(ValueError):
+            imp._add_file(sample_folder_path='/bobsample',
+                          sample_folder_id='folder1', sample_file=sample_file)
+        assert sample_file.status == SampleFile.FAILED
+
+    def mock_download(self, imp, content):
+        """Make IRIDA return content as a streamed response"""
+        resp = Mock()
+        resp.raw = FakeRaw(len(content), content)
+        imp.irida.get.return_value.__enter__.return_value = resp
+        return resp
+
+    def test_session_requests_reuse_connections(self):
+        """Test that concurrent bioblend requests share pooled connections"""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{0}/api/libraries'.format(server.server_port)
+        session = mount_pool(requests.Session(), 4)
+        bioblend_requests = SessionRequests(session)
+
+        try:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                responses = list(executor.map(
+                    lambda i: bioblend_requests.get(url, timeout=5), range(40)))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert all(response.content == b'ok' for response in responses)
+        [(host, num_connections, num_requests)] = pool_stats(session)
+        assert host == '127.0.0.1'
+        assert num_requests == 40
+        assert num_connections <= 4, 'Connections must be kept alive and reused'
+        assert bioblend_requests.exceptions is requests.exceptions
+
+    def test_write_response_memory_is_bounded(self, imp):
+        """Test that streaming a multi-GB response uses a bounded buffer"""
+        size = 4 * 1024 ** 3 + 123
+        resp = Mock()
+        resp.raw = FakeRaw(size)
+        sink = CountingFile()
+
+        tracemalloc.start()
+        try:
+            written = imp._write_response(resp, sink)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        assert written == size and sink.size == size, \
+            'Every byte of the response must be written'
+        assert peak < 2 * imp.DOWNLOAD_CHUNK_SIZE, \
+            'Peak memory must not depend on the file size'
+
+    def test_upload_file_to_galaxy_streams(self, imp):
+        """Test that a file is streamed from IRIDA before uploading it"""
+        content = b'@read1\nACGT\n+\nIIII\n' * 100000
+        self.mock_download(imp, content)
+        uploaded = []
+
+        def upload_file_from_local_path(library_id, file_local_path, folder_id,
+                                        file_type):
+            with open(file_local_path, 'rb') as f:
+                uploaded.append(f.read())
+            return [{'id': '456'}]
+        imp.reg_gi.libraries.upload_file_from_local_path = Mock(
+            side_effect=upload_file_from_local_path)
+
+        sample_file = SampleFile(name='file1.fastq', path='/not/local/file1.fastq',
+                                 href="http://127.0.0.1/api/samples/1/sequenceFiles/1")
+        added = imp.upload_file_to_galaxy(sample_file, '321')
+
+        assert added == [{'id': '456'}]
+        assert uploaded == [content], 'The downloaded file must be uploaded'
+        assert imp.irida.get.call_args[1]['stream'] is True
+
+    def test_upload_file_to_galaxy_hashes_while_downloading(self, imp):
+        """Test that the sha256 computed while downloading is checked"""
+        content = b'>contig1\nACGTACGT\n' * 1000
+        imp.reg_gi.libraries.upload_file_from_local_path = Mock(
+            return_value=[{'id': '456'}])
+        href = "http://127.0.0.1/api/samples/1/assemblies/1"
+
+        self.mock_download(imp, content)
+        sample_file = SampleFile(name='file1.fasta', path='/not/local/file1.fasta',
+                                 href=href,
+                                 upload_sha_256=hashlib.sha256(content).hexdigest())
+        assert imp.upload_file_to_galaxy(sample_file, '321') == [{'id': '456'}]
+
+        self.mock_download(imp, content)
+        sample_file.upload_sha_256 = hashlib.sha256(b'other').hexdigest()
+        with pytest.raises(ValueError) as error:
+            imp.upload_file_to_galaxy(sample_file, '321')
+        assert 'does not match the original sha256' in str(error.value)
+        assert imp.reg_gi.libraries.upload_file_from_local_path.call_count == 1, \
+            'A file with the wrong sha256 must not be uploaded'
+
+    def test_upload_file_to_galaxy_download_cache(self, imp, tmpdir):
+        """Test that a file cached by its sha256 is not downloaded again"""
+        content = b'@read1\nACGT\n+\nIIII\n' * 1000
+        imp.download_cache = DownloadCache(str(tmpdir.join('cache')), 1024 ** 2)
+        uploaded = []
+
+        def upload_file_from_local_path(library_id, file_local_path, folder_id,
+                                        file_type):
+            with open(file_local_path, 'rb') as f:
+                uploaded.append((os.path.basename(file_local_path), f.read()))
+            return [{'id': str(len(uploaded))}]
+        imp.reg_gi.libraries.upload_file_from_local_path = Mock(
+            side_effect=upload_file_from_local_path)
+
+        def sample_file(name, sha_256):
+            return SampleFile(name=name, path='/not/local/' + name,
+                              href="http://127.0.0.1/api/samples/1/sequenceFiles/1",
+                              upload_sha_256=sha_256)
+        sha_256 = hashlib.sha256(content).hexdigest()
+
+        self.mock_download(imp, content)
+        assert imp.upload_file_to_galaxy(sample_file('a.fastq', sha_256), '321') == \
+            [{'id': '1'}]
+        # The same content, imported under another name by another user
+        assert imp.upload_file_to_galaxy(sample_file('b.fastq', sha_256), '654') == \
+            [{'id': '2'}]
+        assert imp.irida.get.call_count == 1, 'A cache hit must skip the download'
+        assert uploaded == [('a.fastq', content), ('b.fastq', content)]
+
+        # Files without a sha256 or size cannot be addressed, and are not kept
+        self.mock_download(imp, content)
+        imp.upload_file_to_galaxy(sample_file('c.fastq', None), '321')
+        imp.upload_file_to_galaxy(sample_file('c.fastq', None), '321')
+        assert imp.irida.get.call_count == 3
+        assert sorted(os.listdir(str(tmpdir.join('cache')))) == \
+            [DiskLRU.LOCK_DIR, 'sha256-' + sha_256], \
+            'Temporary files must not be left in the cache'
+
+    def test_upload_file_to_galaxy_duplicate_downloads(self, imp, tmpdir):
+        """Test that sample files sharing a URL do not share a download"""
+        content = b'@read1\nACGT\n+\nIIII\n'
+        imp.download_cache = DownloadCache(str(tmpdir.join('cache')), 1024 ** 2)
+        imp.reg_gi.libraries.upload_file_from_local_path = Mock(
+            return_value=[{'id': '456'}])
+        downloading = []
+
+        def download_file(sample_file, file_path):
+            assert not downloading, 'A partial file must have one writer'
+            downloading.append(file_path)
+            time.sleep(0.1)
+            with open(file_path, 'wb') as f:
+                f.write(content)
+            downloading.pop()
+            return hashlib.sha256(content).hexdigest()
+        imp.download_file = Mock(side_effect=download_file)
+
+        sample_files = [
+            SampleFile(name='file1.fastq', path='/not/local/file1.fastq',
+                       href="http://127.0.0.1/api/samples/1/sequenceFiles/1",
+                       upload_sha_256=hashlib.sha256(content).hexdigest())
+            for _ in range(2)]
+        with ThreadPoolExecutor(2) as executor:
+            results = list(executor.map(
+                lambda sample_file: imp.upload_file_to_galaxy(sample_file, '321'),
+                sample_files))
+
+        assert results == [[{'id': '456'}], [{'id': '456'}]]
+        assert imp.download_file.call_count == 1, \
+            'The second sample file must use the first one\'s download'
+
+    @pytest.fixture(scope="function")
+    def range_server(self):
+        """Start a local stand-in for IRIDA that drops connections"""
+        server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), DroppingRangeHandler)
+        server.daemon_threads = True
+        server.lock = threading.Lock()
+        server.ranges = []
+        server.drops = []
+        server.ignore_ranges = False
+        rng = random.Random(21)
+        server.content = bytes(rng.getrandbits(8) for _ in range(3 * 1024 * 1024 + 17))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    def range_sample_file(self, range_server):
+        return SampleFile(
+            name='reads.fast5', path='/not/local/reads.fast5',
+            href='http://127.0.0.1:{0}/api/samples/1/fast5/1'.format(
+                range_server.server_port),
+            file_size=len(range_server.content),
+            upload_sha_256=hashlib.sha256(range_server.content).hexdigest())
+
+    def test_download_file_resumes_dropped_connections(self, imp, tmpdir,
+                                                       range_server):
+        """Test that dropped downloads resume where they stopped"""
+        rng = random.Random(7)
+        # Data read in the chunk the connection dropped in is lost
+        imp.DOWNLOAD_CHUNK_SIZE = 64 * 1024
+        range_server.drops = [rng.randrange(imp.DOWNLOAD_CHUNK_SIZE + 1, 512 * 1024)
+                              for _ in range(5)]
+        imp.irida = requests.Session()
+        imp.RESUME_DELAY = 0
+        sample_file = self.range_sample_file(range_server)
+        file_path = str(tmpdir.join('reads.fast5'))
+
+        sha_256 = imp.download_file(sample_file, file_path)
+
+        assert sha_256 == sample_file.upload_sha_256
+        with open(file_path, 'rb') as f:
+            assert f.read() == range_server.content
+        assert len(range_server.ranges) == 6
+        assert range_server.ranges[0] is None
+        offsets = [int(content_range[len('bytes='):-1])
+                   for content_range in range_server.ranges[1:]]
+        assert offsets == sorted(set(offsets)), \
+            'Every resumed download must start where the last one stopped'
+
+    def test_download_file_resumes_partial_file(self, imp, tmpdir, range_server):
+        """Test that a partial file left by an earlier attempt is resumed"""
+        imp.irida = requests.Session()
+        sample_file = self.range_sample_file(range_server)
+        file_path = str(tmpdir.join('reads.fast5'))
+        half = len(range_server.content) // 2
+        with open(file_path, 'wb') as f:
+            f.write(range_server.content[:half])
+
+        assert imp.download_file(sample_file, file_path) == sample_file.upload_sha_256
+        assert range_server.ranges == ['bytes={0}-'.format(half)]
+
+        # A file that does not have the size IRIDA gave is not kept
+        sample_file.file_size += 1
+        imp.config.MAX_DOWNLOAD_RESUMES = 1
+        imp.RESUME_DELAY = 0
+        with pytest.raises(ValueError) as error:
+            imp.download_file(sample_file, file_path)
+        assert 'does not match the original size' in str(error.value)
+        assert not os.path.exists(file_path)
+
+    def test_download_file_in_segments(self, imp, tmpdir, range_server):
+        """Test that large files are downloaded as parallel byte ranges"""
+        imp.DOWNLOAD_CHUNK_SIZE = 64 * 1024
+        imp.config.DOWNLOAD_SEGMENTS = 4
+        imp.config.SEGMENTED_DOWNLOAD_MIN_BYTES = 1024 * 1024
+        imp.irida = requests.Session()
+        imp.RESUME_DELAY = 0
+        # Segments resume from where their own connection dropped
+        range_server.drops = [imp.DOWNLOAD_CHUNK_SIZE * 3 + 5]
+        sample_file = self.range_sample_file(range_server)
+        file_path = str(tmpdir.join('reads.fast5'))
+
+        with mock.patch.object(imp, '_hash_file',
+                               wraps=imp._hash_file) as hash_file:
+            sha_256 = imp.download_file(sample_file, file_path)
+            assert hash_file.call_count == 1
+
+        assert sha_256 == sample_file.upload_sha_256
+        with open(file_path, 'rb') as f:
+            assert f.read() == range_server.content
+        segment_size = -(-len(range_server.content) // 4)
+        starts = sorted(int(r[len('bytes='):].split('-')[0])
+                        for r in range_server.ranges)
+        assert len(starts) == 5
+        for i in range(4):
+            assert i * segment_size in starts
+        assert all(not r.endswith('-') for r in range_server.ranges)
+
+        # A segment that fails leaves nothing behind to resume from
+        os.remove(file_path)
+        imp.config.MAX_DOWNLOAD_RESUMES = 0
+        range_server.drops = [10]
+        with pytest.raises(ValueError):
+            imp.download_file(sample_file, file_path)
+        assert os.listdir(str(tmpdir)) == []
+        imp.config.MAX_DOWNLOAD_RESUMES = 10
+
+        # Without range requests, the file is downloaded in one piece
+        range_server.ignore_ranges = True
+        assert imp.download_file(sample_file, file_path) == sample_file.upload_sha_256
+        with open(file_path, 'rb') as f:
+            assert f.read() == range_server.content
+        assert os.listdir(str(tmpdir)) == ['reads.fast5']
+        range_server.ignore_ranges = False
+
+        # Smaller files are still downloaded over one connection
+        range_server.ranges[:] = []
+        imp.config.SEGMENTED_DOWNLOAD_MIN_BYTES = len(range_server.content) + 1
+        os.remove(file_path)
+        assert imp.download_file(sample_file, file_path) == sample_file.upload_sha_256
+        assert range_server.ranges == [None]
+
+    def test_download_file_skips_hash_without_upload_sha256(self, imp, tmpdir):
+        """Test that files without an uploadSha256 are not hashed"""
+        self.mock_download(imp, b'ACGT')
+        sample_file = SampleFile(name='file1.fastq', path='/not/local/file1.fastq',
+                                 href="http://127.0.0.1/api/samples/1/sequenceFiles/1")
+        with mock.patch('hashlib.sha256') as sha256:
+            assert imp.download_file(sample_file, str(tmpdir.join('file1'))) is None
+            assert sha256.call_count == 0
+
+    def make_journal_sample(self):
+        """Make a sample with a pair and a single file to journal"""
+        sample = Sample("bobname", "paired", "unpaired", "assemblies", "")
+        sample.add_pair(SamplePair(
+            'pair1',
+            SampleFile(name='file1', path="/imaginary/path/file1.fastq",
+                       href="http://127.0.0.1/api/samples/1/pairs/1/files/1"),
+            SampleFile(name='file2', path="/imaginary/path/file2.fastq",
+                       href="http://127.0.0.1/api/samples/1/pairs/1/files/2",
+                       file_size=10, upload_sha_256='abc')))
+        sample.add_file(SampleFile(name='file3', path="/imaginary/path/file3.fastq",
+                                   href="http://127.0.0.1/api/samples/1/sequenceFiles/3"))
+        return sample
+
+    def test_import_journal_round_trip(self, tmpdir):
+        """Test that a journal restores the progress recorded in it"""
+        path = str(tmpdir.join('log_file.journal'))
+        journal = ImportJournal(path, 'digest')
+        assert not journal.resumed
+        sample = self.make_journal_sample()
+        forward = sample.get_reads()[0].forward
+        single = sample.get_reads()[1]
+        journal.record_sample(0, sample)
+        journal.record_samples_resolved(1)
+        journal.record_library('lib1')
+        journal.record_folder('/illumina_reads', 'f1')
+        forward.library_dataset_id = 'd1'
+        forward.status = SampleFile.VERIFYING
+        journal.record_file(forward, '/illumina_reads/bobname/pair1/file1', 'uploaded')
+        forward.verified = True
+        journal.record_file(forward)
+        single.library_dataset_id = 'd3'
+        single.status = SampleFile.VERIFYING
+        journal.record_file(single, '/illumina_reads/bobname/file3', 'uploaded')
+        journal.close()
+        # A record cut off by the process dying is ignored
+        with open(path, 'a') as journal_fh:
+            journal_fh.write('{"type": "fi')
+
+        journal = ImportJournal(path, 'digest')
+        assert journal.resumed
+        samples = journal.get_samples()
+        journal.record_library('lib1')
+        assert journal.restore_files(samples) == 2
+        pair, single = samples[0].get_reads()
+        assert pair.forward.verified and pair.forward.library_dataset_id == 'd1'
+        assert pair.reverse.status == SampleFile.PENDING
+        assert pair.reverse.upload_sha_256 == 'abc' and pair.reverse.file_size == 10
+        assert single.status == SampleFile.VERIFYING
+        assert journal.folders == {'/illumina_reads': 'f1'}
+        assert len(journal.uploaded_files_log) == 2
+        journal.close()
+
+        journal = ImportJournal(path, 'digest')
+        journal.record_library('lib2')
+        assert journal.folders == {} and journal.files == {}, \
+            'Progress in a different library must be forgotten'
+        journal.close()
+
+        journal = ImportJournal(path, 'other digest')
+        assert not journal.resumed and journal.get_samples() is None, \
+            'A journal for other parameters must be discarded'
+        journal.close()
+
+        # An import stopped while resolving samples keeps those it resolved
+        journal = ImportJournal(path, 'digest')
+        journal.record_sample(1, sample)
+        journal.close()
+        journal = ImportJournal(path, 'digest')
+        assert journal.get_samples() is None
+        assert journal.get_sample(0) is None
+        assert journal.get_sample(1).get_reads()[1].name == 'file3'
+        journal.close()
+
+    def test_import_to_galaxy_resumes_from_journal(self, setup_json, tmpdir,
+                                                   monkeypatch):
+        """Test that finished work recorded in the journal is skipped"""
+        monkeypatch.setattr(bioblend.galaxyclient, 'requests',
+                            bioblend.galaxyclient.requests)
+        param_file = tmpdir.join('params.dat')
+        param_file.write(setup_json)
+        log = str(tmpdir.join('log_file'))
+        journal = ImportJournal(
+            log + '.journal', hashlib.sha256(setup_json.encode('utf-8')).hexdigest())
+        sample = self.make_journal_sample()
+        journal.record_sample(0, sample)
+        journal.record_samples_resolved(1)
+        journal.record_library('lib1')
+        journal.record_folder('/illumina_reads', 'f1')
+        journal.record_folder('/references', 'f2')
+        for sample_file in journal_files(sample):
+            sample_file.library_dataset_id = sample_file.name
+            sample_file.verified = True
+            journal.record_file(sample_file, '/illumina_reads/' + sample_file.name,
+                                'uploaded')
+        journal.record_history()
+        journal.close()
+
+        imp = IridaImport(MockConfig())
+        lib = mock.create_autospec(Library)
+        lib.id = 'lib1'
+        imp.get_first_or_make_lib = Mock(return_value=lib)
+        imp.get_IRIDA_session = Mock()
+        imp.make_irida_request = Mock()
+        imp.initial_lib_state = Mock()
+        imp.add_samples_to_history = Mock()
+
+        imp.import_to_galaxy(str(param_file), log, 'hist1')
+
+        assert imp.make_irida_request.call_count == 0, 'IRIDA must not be queried again'
+        assert imp.initial_lib_state.call_count == 0, 'The library must not be listed'
+        assert imp.add_samples_to_history.call_count == 0
+        assert len(imp.uploaded_files_log) == 3
+
+    def test_add_samples_if_nec_links_in_batches(self, imp, monkeypatch):
+        """Test that local files are linked in batches per folder"""
+        sample = Sample("bobname", "", "", "", "")
+        pair = SamplePair(
+            'pair1',
+            SampleFile(name='f.fastq', path='/local/pair/f.fastq',
+                       href="http://127.0.0.1/api/samples/1/pairs/1/files/1"),
+            SampleFile(name='r.fastq', path='/local/pair/r.fastq',
+                       href="http://127.0.0.1/api/samples/1/pairs/1/files/2"))
+        sample.add_pair(pair)
+        singles = []
+        for i in range(3):
+            singles.append(SampleFile(
+                name='s%d.fastq' % i, path='/local/single/s%d.fastq' % i,
+                href="http://127.0.0.1/api/samples/1/sequenceFiles/%d" % i))
+            sample.add_file(singles[-1])
+
+        monkeypatch.setattr(os.path, "isfile", Mock(return_value=True))
+        imp.create_folder_if_nec = Mock(side_effect=lambda path: 'id:' + path)
+        imp.existing_file = Mock(return_value=False)
+
+        def upload_from_galaxy_filesystem(library_id, filesystem_paths, folder_id,
+                                          link_data_only, file_type):
+            # Galaxy does not promise to return datasets in order
+            return [{'id': folder_id + '/' + os.path.basename(path),
+                     'name': os.path.basename(path)}
+                    for path in reversed(filesystem_paths.split('\n'))]
+        imp.reg_gi.libraries.upload_from_galaxy_filesystem = Mock(
+            side_effect=upload_from_galaxy_filesystem)
+
+        assert imp.add_samples_if_nec([sample]) == 5
+
+        calls = imp.reg_gi.libraries.upload_from_galaxy_filesystem.call_args_list
+        batches = sorted(call[0][1] for call in calls)
+        assert batches == ['/local/pair/f.fastq\n/local/pair/r.fastq',
+                           '/local/single/s0.fastq\n/local/single/s1.fastq',
+                           '/local/single/s2.fastq'], \
+            'Files must be linked in batches of LINK_BATCH_SIZE per folder'
+        assert pair.forward.library_dataset_id == \
+            'id:/illumina_reads/bobname/pair1/f.fastq'
+        assert pair.reverse.library_dataset_id == \
+            'id:/illumina_reads/bobname/pair1/r.fastq'
+        for single in singles:
+            assert single.library_dataset_id == 'id:/illumina_reads/bobname/' + single.name
+            assert single.status == SampleFile.VERIFYING
+        assert len(imp.uploaded_files_log) == 5
+        assert imp.exists_in_lib('file', 'name', '/illumina_reads/bobname/s2.fastq') == \
+            ['id:/illumina_reads/bobname/s2.fastq']
+
+    def setup_pipeline(self, imp, monkeypatch, num_samples, events):
+        """Mock IRIDA and Galaxy for samples going through the pipeline"""
+        lock = threading.Lock()
+
+        def record(event):
+            with lock:
+                events.append((event, time.time()))
+
+        def get_sample_meta_item(sample_input):
+            time.sleep(0.02)
+            record('resolved ' + sample_input['name'])
+            return Sample(sample_input['name'], '', '', '', '')
+
+        def add_sample_files(sample, include_assemblies, include_fast5):
+            # The first sample's files are local, and linked
+            folder = '/local/' if sample.name == '0' else '/remote/'
+            for i in range(2):
+                sample.add_file(SampleFile(
+                    name='{0}_{1}.fastq'.format(sample.name, i),
+                    path='{0}{1}_{2}.fastq'.format(folder, sample.name, i),
+                    href='http://127.0.0.1/api/samples/{0}/sequenceFiles/{1}'
+                         .format(sample.name, i)))
+            return sample
+
+        def upload_file_to_galaxy(sample_file, folder_id):
+            record('upload ' + sample_file.name)
+            time.sleep(0.02)
+            return [{'id': 'upload:' + sample_file.name}]
+
+        def upload_from_galaxy_filesystem(library_id, filesystem_paths, folder_id,
+                                          link_data_only, file_type):
+            record('link ' + filesystem_paths)
+            return [{'id': 'link:' + os.path.basename(path),
+                     'name': os.path.basename(path)}
+                    for path in filesystem_paths.split('\n')]
+
+        monkeypatch.setattr(os.path, "isfile",
+                            lambda path: path.startswith('/local/'))
+        imp.config.MAX_IRIDA_WORKERS = 1
+        imp._get_sample_meta_item = Mock(side_effect=get_sample_meta_item)
+        imp._add_sample_files = Mock(side_effect=add_sample_files)
+        imp.create_folder_if_nec = Mock(side_effect=lambda path: 'id:' + path)
+        imp.existing_file = Mock(return_value=False)
+        imp.upload_file_to_galaxy = Mock(side_effect=upload_file_to_galaxy)
+        imp.reg_gi.libraries.upload_from_galaxy_filesystem = Mock(
+            side_effect=upload_from_galaxy_filesystem)
+        imp.reg_gi.libraries.show_dataset.return_value = {'state': 'ok'}
+        return [self.make_sample_input(str(i)) for i in range(num_samples)]
+
+    def test_import_samples_overlaps_stages(self, imp, monkeypatch):
+        """Test that files are transferred while samples are still resolved"""
+        events = []
+        sample_inputs = self.setup_pipeline(imp, monkeypatch, 8, events)
+
+        samples, num_files = imp.import_samples(iter(sample_inputs), False, False)
+
+        assert [sample.name for sample in samples] == [str(i) for i in range(8)]
+        assert num_files == 16
+        for sample in samples:
+            for sample_file in sample.get_reads():
+                assert sample_file.verified
+        first_upload = min(at for event, at in events if event.startswith('upload'))
+        last_resolved = max(at for event, at in events if event.startswith('resolved'))
+        assert first_upload < last_resolved, \
+            'Transfers must start before every sample is resolved'
+        links = [sorted(event[len('link '):].split('\n'))
+                 for event, _ in events if event.startswith('link')]
+        assert links == [['/local/0_0.fastq', '/local/0_1.fastq']], \
+            "A sample's local files must be linked together"
+        assert len(imp.uploaded_files_log) == 16
+
+    def test_async_import_samples_on_event_loop(self, async_imp, monkeypatch):
+        """Test that the asyncio engine drives every stage of the pipeline"""
+        hosts = []
+        call = async_imp._call
+
+        async def spy(host, func, *args):
+            hosts.append(host)
+            return await call(host, func, *args)
+        async_imp._call = spy
+
+        self.test_import_samples_overlaps_stages(async_imp, monkeypatch)
+
+        # 8 samples resolved, 8 given folders, 16 files transferred and at
+        # least one poll of each of them
+        assert hosts.count('irida') == 8
+        assert hosts.count('galaxy') >= 8 + 16 + 16
+
+    def test_async_import_samples_one_transfer_worker(self, async_imp,
+                                                      monkeypatch):
+        """Test that linking from a transfer does not wait for a second slot"""
+        events = []
+        sample_inputs = self.setup_pipeline(async_imp, monkeypatch, 2, events)
+        async_imp.config.MAX_TRANSFER_WORKERS = 1
+        async_imp._limits = async_imp._run(async_imp._make_limits())
+        result = []
+        importer = threading.Thread(target=lambda: result.append(
+            async_imp.import_samples(sample_inputs, False, False)))
+        importer.daemon = True
+
+        importer.start()
+        importer.join(10)
+
+        assert result, 'The import must not deadlock'
+        assert [event for event, _ in events if event.startswith('link')]
+
+    def test_verify_stage_does_not_wait_for_slow_dataset(self, imp):
+        """Test that files arriving later are verified past a slow dataset"""
+        imp.POLL_INITIAL_DELAY = 0.01
+        imp.POLL_MAX_DELAY = 0.05
+        slow_done = threading.Event()
+        slow = self.make_polled_file('slow.fastq', None)
+        slow.state = Mock(side_effect=lambda gi, library_id:
+                          'ok' if slow_done.is_set() else 'running')
+        fast = [self.make_polled_file('fast%d.fastq' % i, ['queued', 'ok'])
+                for i in range(3)]
+        inbox = queue.Queue(1)
+        errors = []
+        verifier = threading.Thread(target=imp._verify_stage, args=(inbox, errors))
+        verifier.daemon = True
+        verifier.start()
+
+        inbox.put(slow)
+        for sample_file in fast:
+            # The inbox only holds one file, so each must be taken in
+            inbox.put(sample_file, timeout=5)
+        deadline = time.time() + 5
+        while not all(sample_file.verified for sample_file in fast):
+            assert time.time() < deadline, 'The fast files must be verified'
+            time.sleep(0.01)
+        assert not slow.verified
+        slow_done.set()
+        inbox.put(imp._END_OF_STAGE)
+        verifier.join(5)
+
+        assert not verifier.is_alive()
+        assert slow.verified and not errors
+
+    def test_import_samples_reports_errors(self, imp, monkeypatch):
+        """Test that a failed sample does not stop the other samples"""
+        events = []
+        sample_inputs = self.setup_pipeline(imp, monkeypatch, 4, events)
+        resolve = imp._get_sample_meta_item.side_effect
+
+        def get_sample_meta_item(sample_input):
+            if sample_input['name'] == '2':
+                raise KeyError('links')
+            return resolve(sample_input)
+        imp._get_sample_meta_item.side_effect = get_sample_meta_item
+
+        with pytest.raises(KeyError):
+            imp.import_samples(sample_inputs, False, False)
+
+        assert len(imp.uploaded_files_log) == 6, \
+            'The files of the other samples must be transferred'
+
+    def test_import_samples_links_after_failed_transfer(self, imp, monkeypatch):
+        """Test that queued files are linked even if a transfer fails"""
+        events = []
+        sample_inputs = self.setup_pipeline(imp, monkeypatch, 1, events)
+
+        def existing_file(sample_file_path, galaxy_name, size, sample_file):
+            if sample_file_path.endswith('0_1.fastq'):
+                raise ValueError('Galaxy is unavailable')
+            return False
+        imp.existing_file = Mock(side_effect=existing_file)
+
+        with pytest.raises(ValueError):
+            imp.import_samples(sample_inputs, False, False)
+
+        assert [event for event, _ in events if event.startswith('link')] == \
+            ['link /local/0_0.fastq']
+        assert imp.reg_gi.libraries.show_dataset.call_count == 1, \
+            'The linked file must be verified'
+
+    def test_import_samples_journals_each_sample(self, imp, monkeypatch, tmpdir):
+        """Test that samples resolved before a failure are not resolved again"""
+        events = []
+        sample_inputs = self.setup_pipeline(imp, monkeypatch, 4, events)
+        resolve = imp._get_sample_meta_item.side_effect
+
+        def get_sample_meta_item(sample_input):
+            if sample_input['name'] == '2':
+                raise KeyError('links')
+            return resolve(sample_input)
+        imp._get_sample_meta_item.side_effect = get_sample_meta_item
+        path = str(tmpdir.join('log_file.journal'))
+        imp.journal = ImportJournal(path, 'digest')
+        monkeypatch.setattr(os.path, "isfile",
+                            lambda file_path: file_path.startswith('/local/')
+                            or file_path == path)
+
+        with pytest.raises(KeyError):
+            imp.import_samples(sample_inputs, False, False)
+        imp.journal.close()
+
+        imp.journal = ImportJournal(path, 'digest')
+        assert imp.journal.get_samples() is None
+        imp._get_sample_meta_item.side_effect = resolve
+        imp._get_sample_meta_item.reset_mock()
+        samples, _ = imp.import_samples(sample_inputs, False, False)
+        imp.journal.record_samples_resolved(len(samples))
+        imp.journal.close()
+
+        assert [call[0][0]['name'] for call in
+                imp._get_sample_meta_item.call_args_list] == ['2']
+        assert [sample.name for sample in samples] == ['0', '1', '2', '3']
+        journal = ImportJournal(path, 'digest')
+        assert [sample.name for sample in journal.get_samples()] == \
+            ['0', '1', '2', '3']
+        journal.close()
+
+    def test_import_to_galaxy_retries_failed_file(self, imp, monkeypatch,
+                                                  tmpdir):
+        """Test that a file Galaxy fails to import is transferred again"""
+        monkeypatch.setattr(bioblend.galaxyclient, 'requests',
+                            bioblend.galaxyclient.requests)
+        events = []
+        sample_inputs = self.setup_pipeline(imp, monkeypatch, 2, events)
+        param_path = str(tmpdir.join('params.dat'))
+        self.write_param_file(param_path, sample_inputs)
+        monkeypatch.setattr(galaxy, 'GalaxyInstance', Mock(return_value=imp.reg_gi))
+        imp.config.RETRY_DELAY = 0
+        imp.get_IRIDA_session = Mock()
+        imp.get_first_or_make_lib = Mock(return_value=imp.library)
+        imp.add_samples_to_history = Mock()
+        polls = []
+
+        def show_dataset(library_id, dataset_id):
+            assert dataset_id is not None, 'A failed file must not be polled'
+            polls.append(dataset_id)
+            if dataset_id == 'upload:1_0.fastq' and polls.count(dataset_id) == 1:
+                return {'state': 'error'}
+            return {'state': 'ok'}
+        imp.reg_gi.libraries.show_dataset = Mock(side_effect=show_dataset)
+        imp.reg_gi.libraries.delete_library_dataset.return_value = {'deleted': True}
+
+        imp.import_to_galaxy(param_path, None, 'hist1')
+
+        uploads = [event for event, _ in events if event.startswith('upload')]
+        assert uploads.count('upload 1_0.fastq') == 2
+        assert uploads.count('upload 1_1.fastq') == 1, \
+            'Only the failed file must be transferred again'
+        samples = imp.add_samples_to_history.call_args[0][0]
+        assert all(sample_file.verified for sample in samples
+                   for sample_file in sample.get_reads())
+
     def test_assign_ownership_if_nec(self, imp):
         # TODO: write the functionality for this to test
         return True
 
-    def test_import_to_galaxy(self, setup_json):
+    def test_import_to_galaxy(self, setup_json, monkeypatch):
         """Test reading a file and running apropriate methods"""
+        # Put back by import_to_galaxy, and by monkeypatch if it fails to
+        bioblend_requests = bioblend.galaxyclient.requests
+        monkeypatch.setattr(bioblend.galaxyclient, 'requests', bioblend_requests)
         mock.patch('bioblend.galaxy.objects.GalaxyInstance', autospec=True)
         mocked_open_function = mock.mock_open(read_data=setup_json)
 
@@ -463,6 +2094,7 @@ class TestIridaImport:
             imp.get_sample_file = Mock()
             imp.get_sample_meta = Mock()
             imp.get_samples = Mock()
+            imp.import_samples = Mock(return_value=([], 0))
             imp.configure = Mock()
             imp.MAX_RETRIES = 3
             imp.make_irida_request = Mock()
@@ -473,6 +2105,8 @@ class TestIridaImport:
             # Config data to come
             imp.import_to_galaxy("any_string", None, history['id'])
 
+            assert bioblend.galaxyclient.requests is bioblend_requests, \
+                "bioblend's requests module must be put back"
             assert isinstance(imp.gi, GalaxyInstance), \
                    'A GalaxyInstance must be created'
             assert imp.get_first_or_make_lib.call_count == 1, \